@@ -5,8 +5,27 @@ import sys
 import tkMessageBox
 import re
 import logging
+import time
+import json
+import hashlib
+import os
+import marshal
+import zlib
+import itertools
+import gzip
+import zipfile
+import subprocess
+
+try:
+	import resource
+except ImportError:
+	#not available on Windows, the memory report then only lists retained sizes
+	resource = None
+
+from collections import OrderedDict
 
 from optparse import OptionParser
+from contextlib import contextmanager
 
 newline = '\r\n'
 
@@ -33,6 +52,11 @@ LOGGING_LEVELS = {'critical': logging.CRITICAL,
                   'debug': logging.DEBUG}
 
 
+def sideNames(count):
+	'''Source tags for count merge inputs: A, B, C...'''
+	return [ chr( ord('A') + i ) for i in range(count) ]
+
+
 class redict(dict):
 	'''A dictionary enhancement where missing keys are looked up in a seperate dict'''
 	def setBase(self, base):
@@ -44,11 +68,596 @@ class redict(dict):
 		except KeyError:
 			raise KeyError(key)
 
+########################################################
+##
+##   Profiling
+##
+########################################################
+
+class profiler:
+	'''Opt-in timing of the merge phases and of the individual objects within them'''
+	labelFinders = [ re.compile( '^' + key + '=(.*)$', re.M ) for key in ['Nm', 'Cmn1', 'H'] ]
+	
+	def __init__(self):
+		self.enabled = False
+		self.started = time.time()
+		#object type currently being merged, used to file object timings
+		self.objType = ''
+		#chrome trace events, one complete ('X') event per phase
+		self.events = []
+		#(kind, type, name) -> [seconds, count]
+		self.objects = {}
+		#memory mode: per phase [name, peak before, peak after, resident before, resident after] in bytes
+		self.memory = False
+		self.phases = []
+		#(what, type) -> bytes still referenced once the phase that built it is done
+		self.retainedSizes = OrderedDict()
+	
+	@contextmanager
+	def phase(self, name):
+		'''Time a phase of the merge for the trace timeline'''
+		if not self.enabled:
+			yield
+			return
+		started = time.time()
+		if self.memory:
+			entry = [ name, self.peakMemory(), 0, self.residentMemory(), 0 ]
+			self.phases.append(entry)
+		try:
+			yield
+		finally:
+			self.events.append( {'name': name, 'ph': 'X', 'pid': 1, 'tid': 1,
+								 'ts': int( (started - self.started) * 1000000 ),
+								 'dur': int( (time.time() - started) * 1000000 )} )
+			if self.memory:
+				entry[2] = self.peakMemory()
+				entry[4] = self.residentMemory()
+				self.events.append( {'name': 'memory', 'ph': 'C', 'pid': 1, 'tid': 1,
+									 'ts': int( (time.time() - self.started) * 1000000 ),
+									 'args': {'peak MB': entry[2] / 1048576.0, 'resident MB': entry[4] / 1048576.0}} )
+	
+	@contextmanager
+	def object(self, kind, element):
+		'''Time the work done on a single object, given as an SMW object string'''
+		if not self.enabled:
+			yield
+			return
+		started = time.time()
+		try:
+			yield
+		finally:
+			self.addObject( kind, self.objType, self.label(element), time.time() - started )
+	
+	def label(self, element):
+		'''Find a readable name for an SMW object string'''
+		for finder in self.labelFinders:
+			found = finder.search(element)
+			if found:
+				return found.group(1)
+		return '?'
+	
+	def addObject(self, kind, objType, name, seconds):
+		entry = self.objects.setdefault( (kind, objType, name), [0.0, 0] )
+		entry[0] += seconds
+		entry[1] += 1
+	
+	def report(self, top=20):
+		'''Return the top offending objects as text'''
+		ranked = sorted( self.objects.items(), key=lambda item: item[1][0], reverse=True )
+		out = ['%10s %6s  %-6s %-6s %s' % ('seconds', 'count', 'kind', 'type', 'name')]
+		for (kind, objType, name), (seconds, count) in ranked[:top]:
+			out.append( '%10.4f %6d  %-6s %-6s %s' % (seconds, count, kind, objType, name) )
+		return '\n'.join(out) + '\n'
+	
+	def peakMemory(self):
+		'''Peak resident size of the process so far, in bytes (0 if unknown)'''
+		if not resource:
+			return 0
+		peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+		#kilobytes on Linux, bytes on Mac OS X
+		if sys.platform == 'darwin':
+			return peak
+		return peak * 1024
+	
+	def residentMemory(self):
+		'''Current resident size of the process, in bytes (0 if unknown)'''
+		try:
+			f = open('/proc/self/statm')
+			pages = int( f.read().split()[1] )
+			f.close()
+		except (IOError, IndexError, ValueError):
+			return 0
+		return pages * os.sysconf('SC_PAGE_SIZE')
+	
+	def retained(self, what, objType, data):
+		'''Record how much memory data, kept for a later phase, holds on to'''
+		if not self.memory:
+			return
+		key = (what, objType)
+		self.retainedSizes[key] = self.retainedSizes.get(key, 0) + deepSize(data)
+	
+	def memoryReport(self):
+		'''Return the per phase and per object type memory use as text'''
+		mb = 1048576.0
+		out = ['%-32s %10s %10s %10s' % ('phase', 'peak MB', '+peak MB', '+resident')]
+		for name, peakBefore, peakAfter, residentBefore, residentAfter in self.phases:
+			out.append( '%-32s %10.1f %10.1f %10.1f' % (name, peakAfter / mb, (peakAfter - peakBefore) / mb, (residentAfter - residentBefore) / mb) )
+		out.append('')
+		out.append( '%-32s %-6s %10s' % ('retained', 'type', 'MB') )
+		ranked = sorted( self.retainedSizes.items(), key=lambda item: item[1], reverse=True )
+		for (what, objType), size in ranked:
+			out.append( '%-32s %-6s %10.2f' % (what, objType, size / mb) )
+		return '\n'.join(out) + '\n'
+	
+	def writeTrace(self, filename):
+		'''Write the phases as a chrome://tracing (trace event format) file'''
+		f = open(filename, 'wb')
+		json.dump( {'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f )
+		f.close()
+
+def deepSize(data, seen=None):
+	'''Approximate number of bytes held by data and everything it references'''
+	if seen is None:
+		seen = set()
+	if id(data) in seen:
+		return 0
+	seen.add( id(data) )
+	size = sys.getsizeof(data)
+	if isinstance(data, dict):
+		for key, value in data.iteritems():
+			size += deepSize(key, seen) + deepSize(value, seen)
+	elif isinstance(data, (list, tuple, set, frozenset)):
+		for item in data:
+			size += deepSize(item, seen)
+	elif hasattr(data, '__dict__'):
+		size += deepSize(data.__dict__, seen)
+	return size
+
+profile = profiler()
+
+
 ########################################################
 ##
 ##   Merge classes and objects
 ##
 ########################################################
+
+class lruCache:
+	'''In-memory least recently used cache, bounded by the total size of its entries'''
+	def __init__(self, maxSize):
+		self.maxSize = maxSize
+		self.size = 0
+		self._data = OrderedDict()
+	
+	def __len__(self):
+		return len(self._data)
+	
+	def get(self, key):
+		'''Return the entry for key (marking it as recently used) or None'''
+		try:
+			value, size = self._data.pop(key)
+		except KeyError:
+			return None
+		self._data[key] = (value, size)
+		return value
+	
+	def put(self, key, value, size=1):
+		if self._data.has_key(key):
+			self.size -= self._data.pop(key)[1]
+		self._data[key] = (value, size)
+		self.size += size
+		#evict the oldest entries, but always keep the newest one
+		while self.size > self.maxSize and len(self._data) > 1:
+			oldKey, (oldValue, oldSize) = self._data.popitem(last=False)
+			self.size -= oldSize
+
+
+def contentKey(elements):
+	'''Hash a list of SMW object strings'''
+	h = hashlib.sha1()
+	for element in elements:
+		h.update(element)
+		h.update('\0')
+	return h.hexdigest()
+
+
+class baseIndex:
+	'''Alignment index over one base section, built once and shared by every diff against it.
+	   Holds the positions of each element and the anchor candidates (elements unique in the base).'''
+	def __init__(self, x):
+		self.x = x
+		self.positions = {}
+		for pos in range( len(x) ):
+			self.positions.setdefault( x[pos], [] ).append(pos)
+		self.anchors = set( [ element for element in self.positions if len(self.positions[element]) == 1 ] )
+	
+	def __len__(self):
+		return len(self.x)
+	
+	def opcodes(self, side):
+		'''Opcodes turning the base into side, computed against the shared index'''
+		return baseMatcher(self, side).get_opcodes()
+	
+	def moves(self, side, opcodes):
+		'''Blocks of base objects that the side moved, i.e. removed in one place and added
+		   back in another.  Objects are matched by hash through the position index and
+		   consecutive matches are chained into [base position, side position, length] blocks.'''
+		removed = set()
+		for tag, i1, i2, j1, j2 in opcodes:
+			if tag == 'delete' or tag == 'replace':
+				removed.update( range(i1, i2) )
+		
+		blocks = []
+		for tag, i1, i2, j1, j2 in opcodes:
+			if tag == 'insert' or tag == 'replace':
+				for j in range(j1, j2):
+					for i in self.positions.get( side[j], () ):
+						if not i in removed:
+							continue
+						if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+							blocks[-1][2] += 1
+						else:
+							blocks.append( [i, j, 1] )
+						break
+		return blocks
+	
+	#base indexes kept between diffs (and merges) within this process, bounded by element count
+	cache = lruCache(100000)
+	
+	@classmethod
+	def lookup(cls, x):
+		'''Return the shared index for base list x, building it if needed'''
+		key = contentKey(x)
+		index = cls.cache.get(key)
+		if index is None:
+			index = cls(x)
+			cls.cache.put( key, index, len(x) )
+		return index
+
+
+class baseMatcher( difflib.SequenceMatcher ):
+	'''SequenceMatcher from a base to a side that looks matches up in the shared baseIndex
+	   instead of indexing the side.  Finds exactly the same blocks as
+	   SequenceMatcher(None, base, side), so the diff output does not change.'''
+	def __init__(self, index, side):
+		self.index = index
+		difflib.SequenceMatcher.__init__(self, None, index.x, side)
+	
+	def _SequenceMatcher__chain_b(self):
+		#no side index needed, only the autojunk popular set of the side
+		b = self.b
+		self.b2j = {}
+		popular = set()
+		n = len(b)
+		if self.autojunk and n >= 200:
+			ntest = n // 100 + 1
+			counts = {}
+			for elt in b:
+				counts[elt] = counts.get(elt, 0) + 1
+			popular = set( [ elt for elt in counts if counts[elt] > ntest ] )
+		self.isbjunk = set().__contains__
+		self.isbpopular = popular.__contains__
+	
+	def find_longest_match(self, alo, ahi, blo, bhi):
+		a, b, positions, isbpopular = self.a, self.b, self.index.positions, self.isbpopular
+		besti, bestj, bestsize = alo, blo, 0
+		#walk the side and look each element up in the base, i2len[i] = length of the
+		#match ending with a[i] and b[j-1].  Ties go to the earliest in a, then in b, as in difflib.
+		i2len = {}
+		nothing = []
+		for j in xrange(blo, bhi):
+			i2lenget = i2len.get
+			newi2len = {}
+			if not isbpopular( b[j] ):
+				for i in positions.get(b[j], nothing):
+					if i < alo:
+						continue
+					if i >= ahi:
+						break
+					k = newi2len[i] = i2lenget(i-1, 0) + 1
+					if k > bestsize or ( k == bestsize and i-k+1 < besti ):
+						besti, bestj, bestsize = i-k+1, j-k+1, k
+			i2len = newi2len
+		
+		#extend through popular elements the same way difflib does
+		while besti > alo and bestj > blo and a[besti-1] == b[bestj-1]:
+			besti, bestj, bestsize = besti-1, bestj-1, bestsize+1
+		while besti+bestsize < ahi and bestj+bestsize < bhi and a[besti+bestsize] == b[bestj+bestsize]:
+			bestsize += 1
+		return difflib.Match(besti, bestj, bestsize)
+
+
+class smwDiffer( difflib.Differ ):
+	'''Differ used by the merge engine.
+	   Intraline matching (_fancy_replace) is where a few huge objects can eat the
+	   run time, so it is attributed to the objects involved when profiling, and it
+	   is limited by a budget after which replaced blocks are diffed plainly.'''
+	#budget for the intraline matching done by one differ (one per-type merge), 0 = unlimited
+	maxComparisons = 0
+	maxSeconds = 0
+	#recognize relocated blocks of objects as moves (--detect-moves)
+	detectMoves = False
+	
+	def __init__(self, *args, **kwargs):
+		difflib.Differ.__init__(self, *args, **kwargs)
+		self._depth = 0
+		self.comparisons = 0
+		self.started = time.time()
+		#count of replaced blocks that fell back to the plain diff
+		self.fallbacks = 0
+	
+	def outOfTime(self):
+		return self.maxSeconds and time.time() - self.started > self.maxSeconds
+	
+	def overBudget(self, cost):
+		'''Charge cost pair comparisons to the budget, returning True if it is exhausted'''
+		if self.outOfTime():
+			return True
+		if self.maxComparisons and self.comparisons + cost > self.maxComparisons:
+			return True
+		self.comparisons += cost
+		return False
+	
+	def _fallback(self, a, alo, ahi, b, blo, bhi):
+		'''Cheaper replace: the base lines are removed and the side lines added, without intraline matching'''
+		self.fallbacks += 1
+		for line in self._dump('-', a, alo, ahi):
+			yield line
+		for line in self._dump('+', b, blo, bhi):
+			yield line
+	
+	def _fancy_replace(self, a, alo, ahi, b, blo, bhi):
+		#_fancy_replace recurses through _fancy_helper; only the outermost call is charged comparisons
+		if self._depth:
+			for line in self._replace(a, alo, ahi, b, blo, bhi):
+				yield line
+			return
+		
+		if self.overBudget( (ahi - alo) * (bhi - blo) ):
+			for line in self._fallback(a, alo, ahi, b, blo, bhi):
+				yield line
+			return
+		
+		self._depth += 1
+		started = time.time()
+		try:
+			lines = list( self._replace(a, alo, ahi, b, blo, bhi) )
+		finally:
+			self._depth -= 1
+		
+		if profile.enabled:
+			#share the time between the objects of the block by size
+			elapsed = time.time() - started
+			block = a[alo:ahi] + b[blo:bhi]
+			size = float( sum( [ len(element) for element in block ] ) ) or 1.0
+			for element in block:
+				profile.addObject( 'diff', profile.objType, profile.label(element), elapsed * len(element) / size )
+		
+		for line in lines:
+			yield line
+	
+	def _replace(self, a, alo, ahi, b, blo, bhi):
+		'''Intraline matching of a replaced block, timed only when there is a time budget'''
+		if self.maxSeconds:
+			return self._timedReplace(a, alo, ahi, b, blo, bhi)
+		return difflib.Differ._fancy_replace(self, a, alo, ahi, b, blo, bhi)
+	
+	def _timedReplace(self, a, alo, ahi, b, blo, bhi):
+		'''difflib.Differ._fancy_replace, checking the time budget on every line of the
+		   search for the best matching pair (the part that can run for minutes on large
+		   objects) and falling back to the plain replace once it is spent'''
+		# don't synch up unless the lines have a similarity score of at least cutoff
+		best_ratio, cutoff = 0.74, 0.75
+		cruncher = difflib.SequenceMatcher(self.charjunk)
+		eqi, eqj = None, None   # 1st indices of equal lines (if any)
+		
+		# search for the pair that matches best without being identical
+		for j in xrange(blo, bhi):
+			if self.outOfTime():
+				for line in self._fallback(a, alo, ahi, b, blo, bhi):
+					yield line
+				return
+			bj = b[j]
+			cruncher.set_seq2(bj)
+			for i in xrange(alo, ahi):
+				ai = a[i]
+				if ai == bj:
+					if eqi is None:
+						eqi, eqj = i, j
+					continue
+				cruncher.set_seq1(ai)
+				# the quick upper bounds first, ratio() is expensive
+				if cruncher.real_quick_ratio() > best_ratio and \
+					  cruncher.quick_ratio() > best_ratio and \
+					  cruncher.ratio() > best_ratio:
+					best_ratio, best_i, best_j = cruncher.ratio(), i, j
+		if best_ratio < cutoff:
+			# no non-identical "pretty close" pair
+			if eqi is None:
+				# no identical pair either -- treat it as a straight replace
+				for line in self._plain_replace(a, alo, ahi, b, blo, bhi):
+					yield line
+				return
+			# no close pair, but an identical pair -- synch up on that
+			best_i, best_j, best_ratio = eqi, eqj, 1.0
+		else:
+			# there's a close pair, so forget the identical pair (if any)
+			eqi = None
+		
+		# pump out diffs from before the synch point
+		for line in self._fancy_helper(a, alo, best_i, b, blo, best_j):
+			yield line
+		
+		# do intraline marking on the synch pair
+		aelt, belt = a[best_i], b[best_j]
+		if eqi is None:
+			# pump out a '-', '?', '+', '?' quad for the synched lines
+			atags = btags = ""
+			cruncher.set_seqs(aelt, belt)
+			for tag, ai1, ai2, bj1, bj2 in cruncher.get_opcodes():
+				la, lb = ai2 - ai1, bj2 - bj1
+				if tag == 'replace':
+					atags += '^' * la
+					btags += '^' * lb
+				elif tag == 'delete':
+					atags += '-' * la
+				elif tag == 'insert':
+					btags += '+' * lb
+				elif tag == 'equal':
+					atags += ' ' * la
+					btags += ' ' * lb
+				else:
+					raise ValueError, 'unknown tag %r' % (tag,)
+			for line in self._qformat(aelt, belt, atags, btags):
+				yield line
+		else:
+			# the synch pair is identical
+			yield '  ' + aelt
+		
+		# pump out diffs from after the synch point
+		for line in self._fancy_helper(a, best_i+1, ahi, b, best_j+1, bhi):
+			yield line
+	
+	def compareToBase(self, x, side):
+		'''Same output as compare(x, side), using the shared index of base x'''
+		index = baseIndex.lookup(x)
+		opcodes = index.opcodes(side)
+		return self.expandOpcodes( x, side, opcodes, self.movedObjects(index, side, opcodes) )
+	
+	def movedObjects(self, index, side, opcodes):
+		'''The set of objects the side moved, when move detection is on'''
+		if not self.detectMoves:
+			return set()
+		blocks = index.moves(side, opcodes)
+		if blocks:
+			logging.debug( 'smwDiffer: ' + str(len(blocks)) + ' moved block(s), ' + str( sum( [ block[2] for block in blocks ] ) ) + ' object(s)' )
+		moved = set()
+		for i, j, length in blocks:
+			moved.update( index.x[i:i + length] )
+		return moved
+	
+	def expandOpcodes(self, x, side, opcodes, moved=set()):
+		'''Turn opcodes from x to side into Differ output.
+		   Replaced blocks holding moved objects are written plainly: intraline matching a
+		   relocated block against whatever now sits in its old place is wasted work.'''
+		for tag, xlo, xhi, slo, shi in opcodes:
+			if tag == 'replace' and moved and ( moved.intersection( x[xlo:xhi] ) or moved.intersection( side[slo:shi] ) ):
+				g = itertools.chain( self._dump('-', x, xlo, xhi), self._dump('+', side, slo, shi) )
+			elif tag == 'replace':
+				g = self._fancy_replace(x, xlo, xhi, side, slo, shi)
+			elif tag == 'delete':
+				g = self._dump('-', x, xlo, xhi)
+			elif tag == 'insert':
+				g = self._dump('+', side, slo, shi)
+			else:
+				g = self._dump(' ', x, xlo, xhi)
+			for line in g:
+				yield line
+
+
+def _expandSegment(job):
+	'''Worker for anchorSplit: the Differ output of one segment'''
+	x, side, opcodes, moved = job
+	return list( smwDiffer().expandOpcodes(x, side, opcodes, moved) )
+
+class anchorSplit:
+	'''Diff a large base section against its sides in parallel segments.
+	   The opcodes of every side are computed once (cheap, via the shared baseIndex), then
+	   cut at anchors: elements unique in the base that every side left unchanged.  The
+	   expensive part, expanding each segment's replaced blocks with intraline matching,
+	   runs in worker processes.  Differ output is the concatenation of its per-opcode
+	   output, so joining the segments gives exactly the sequential result.'''
+	jobs = 1
+	#smallest section (in objects) worth splitting
+	threshold = 2000
+	pool = None
+	
+	@classmethod
+	def usable(cls, x, differ):
+		#a diff budget is charged in order, which a split run can't reproduce
+		return cls.jobs > 1 and len(x) >= cls.threshold and not ( differ.maxComparisons or differ.maxSeconds )
+	
+	@classmethod
+	def splits(cls, index, opcodeLists, count):
+		'''Pick up to count-1 anchor positions in the base, spread evenly'''
+		unchanged = [ True ] * len(index)
+		for opcodes in opcodeLists:
+			same = [ False ] * len(index)
+			for tag, i1, i2, j1, j2 in opcodes:
+				if tag == 'equal':
+					same[i1:i2] = [ True ] * (i2 - i1)
+			unchanged = [ u and s for u, s in zip(unchanged, same) ]
+		anchors = [ pos for pos in range( 1, len(index) ) if unchanged[pos] and index.x[pos] in index.anchors ]
+		
+		chosen = []
+		for n in range( 1, count ):
+			target = len(index) * n // count
+			for pos in anchors:
+				if pos >= target:
+					if not pos in chosen:
+						chosen.append(pos)
+					break
+		return chosen
+	
+	@classmethod
+	def cut(cls, x, side, opcodes, splits, moved):
+		'''Cut opcodes at the given base positions (each inside an equal block) into worker jobs'''
+		segments = []
+		current = []
+		splits = list(splits)
+		for tag, i1, i2, j1, j2 in opcodes:
+			while splits and tag == 'equal' and i1 <= splits[0] < i2:
+				pos = splits.pop(0)
+				sidePos = j1 + (pos - i1)
+				if pos > i1:
+					current.append( ('equal', i1, pos, j1, sidePos) )
+				segments.append(current)
+				current = []
+				i1, j1 = pos, sidePos
+			if i1 < i2 or j1 < j2:
+				current.append( (tag, i1, i2, j1, j2) )
+		segments.append(current)
+		
+		jobs = []
+		for segment in segments:
+			if not segment:
+				continue
+			xlo, slo = segment[0][1], segment[0][3]
+			xhi, shi = segment[-1][2], segment[-1][4]
+			local = [ (tag, i1 - xlo, i2 - xlo, j1 - slo, j2 - slo) for tag, i1, i2, j1, j2 in segment ]
+			jobs.append( (x[xlo:xhi], side[slo:shi], local, moved) )
+		return jobs
+	
+	@classmethod
+	def compare(cls, x, sides):
+		'''Differ output of x against every side, computed in parallel segments'''
+		import multiprocessing
+		if cls.pool is None:
+			cls.pool = multiprocessing.Pool(cls.jobs)
+		
+		index = baseIndex.lookup(x)
+		opcodeLists = [ index.opcodes(side) for side in sides ]
+		splits = cls.splits( index, opcodeLists, cls.jobs * 4 )
+		logging.debug( 'anchorSplit: ' + str(len(x)) + ' objects in ' + str(len(splits) + 1) + ' segments' )
+		
+		jobs = []
+		counts = []
+		differ = smwDiffer()
+		for side, opcodes in zip(sides, opcodeLists):
+			sideJobs = cls.cut( x, side, opcodes, splits, differ.movedObjects(index, side, opcodes) )
+			jobs.extend(sideJobs)
+			counts.append( len(sideJobs) )
+		
+		results = cls.pool.map(_expandSegment, jobs)
+		diffs = []
+		for count in counts:
+			diff = []
+			for segment in results[:count]:
+				diff.extend(segment)
+			results = results[count:]
+			diffs.append(diff)
+		return diffs
+
 	
 class Merge:
 	class marker:
@@ -56,11 +665,23 @@ class Merge:
 		remove = '- '
 		inline = '? '
 		same   = '  '
-	differ = difflib.Differ()
+	differ = smwDiffer()
+	#whether the conflict manager keeps the additions of both sides (used by --check)
+	greedyAdds = False
+	#set by a conflict manager that gave up and dropped objects; such results are never cached
+	lossy = False
 	
-	def __init__(self, a=False, b=False, x=False):
+	def __init__(self, a=False, b=False, x=False, sides=False, names=False, objType=''):
 		self.ran = False
-		if a<>False and b<>False and x<>False:
+		#every merge gets its own differ, and with it its own diff budget
+		self.differ = smwDiffer()
+		#the SMW object type being merged, if any (used to file incremental state)
+		self.objType = objType
+		if sides<>False and x<>False:
+			self.conflict, self.result = self.nWay(sides, x, names)
+			self.ran = True
+			
+		elif a<>False and b<>False and x<>False:
 			self.conflict, self.result = self.threeWay(a,b,x)
 			self.ran = True
 			
@@ -122,8 +743,8 @@ class Merge:
 
 	#perform a three-way merge using _conflictManger for any conflicts
 	def threeWay(self, a, b, x, a_name = 'A', b_name = 'B'):
-		xa = list( self.differ.compare(x, a) )
-		xb = list( self.differ.compare(x, b) )
+		with profile.phase('diff'):
+			xa, xb = self._sideDiffs(x, [a, b])
 		m = []
 		index_a = 0
 		index_b = 0
@@ -137,6 +758,7 @@ class Merge:
 		
 		self.eliminateInlineMarkers( xa )
 		self.eliminateInlineMarkers( xb )
+		(xa, xb), (moved_a, moved_b) = self._carryMoves( [xa, xb], [a_name, b_name] )
 		
 		self.a = a
 		self.b = b
@@ -184,7 +806,8 @@ class Merge:
 			# At this point, the only remaining possiblity is an add from both sides that doesn't match
 			
 			# possible conflict.  Attempt last ditch merge
-			mergedLine = self._lastDitchMerge( xa[index_a][2:], xb[index_b][2:] )
+			with profile.object( 'merge', xa[index_a][2:] ):
+				mergedLine = self._lastDitchMerge( xa[index_a][2:], xb[index_b][2:] )
 			if mergedLine:
 				m.append( mergedLine )
 				index_a += 1
@@ -194,6 +817,8 @@ class Merge:
 			# conflict - build list of conflicting lines and pass to handler
 			ca = []
 			cb = []
+			start_a = index_a
+			start_b = index_b
 			#build list of conflicting lines from A
 			while (index_a < len(xa)) and not xa[index_a].startswith( self.marker.same ):
 				ca.append( self._preprocessAdd(xa[index_a][2:], a_name) )
@@ -202,9 +827,42 @@ class Merge:
 			while (index_b < len(xb)) and not xb[index_b].startswith( self.marker.same ):
 				cb.append( self._preprocessAdd(xb[index_b][2:], b_name) )
 				index_b += 1
-				
+			
+			#both lists have to cover the same stretch of the base, or the walk loses step
+			#(and stalls on two different unchanged lines): extend the one that is behind
+			while True:
+				behind_a = self._baseCount( xa[start_a:index_a] ) - self._baseCount( xb[start_b:index_b] )
+				if behind_a < 0 and index_a < len(xa):
+					index_a += 1
+					while (index_a < len(xa)) and not xa[index_a].startswith( self.marker.same ):
+						index_a += 1
+				elif behind_a > 0 and index_b < len(xb):
+					index_b += 1
+					while (index_b < len(xb)) and not xb[index_b].startswith( self.marker.same ):
+						index_b += 1
+				else:
+					break
+			
+			#if either side only moved objects here, it is not a conflict: the moved objects
+			#come out where they were moved to, and both sides' changes are kept
+			if self._onlyMoves( xa[start_a:index_a], moved_a ) or self._onlyMoves( xb[start_b:index_b], moved_b ):
+				m.extend( self._applyBoth( xa[start_a:index_a], xb[start_b:index_b], a_name, b_name ) )
+				continue
+			
+			#a stretch holding base elements or removals, not just additions, is merged one
+			#base element at a time like nWay, so only real clashes reach the conflict manager
+			items = [ xa[start_a:index_a], xb[start_b:index_b] ]
+			if self._baseCount( items[0] ):
+				stretch = [ item[2:] for item in items[0] if not item.startswith( self.marker.add ) ]
+				aligned = [ self._alignToBase(stretch, diff) for diff in items ]
+				stretchConflict, cm = self._walkAligned( stretch, aligned, [a_name, b_name], [moved_a, moved_b], list(lastStatus) )
+				m.extend(cm)
+				if stretchConflict:
+					had_conflict = True
+				continue
+			
 			#pass lists to conflict manager
-			resolved, cm = self._conflictManager(ca, cb, lastStatus)
+			resolved, cm = self._resolveConflict(ca, cb, lastStatus)
 			m.extend(cm)
 			if not resolved:
 				had_conflict = True
@@ -217,10 +875,230 @@ class Merge:
 
 		return had_conflict, m
 	
+	def _sideDiffs(self, x, sides):
+		'''The Differ output of base x against every side.
+		   Diffs saved by a previous merge (--state) are patched rather than recomputed.'''
+		diffs = [ None ] * len(sides)
+		if state and self.objType:
+			diffs = state.reuse( self.objType, x, sides, self.differ )
+		
+		missing = [ n for n in range( len(sides) ) if diffs[n] is None ]
+		if missing:
+			if anchorSplit.usable(x, self.differ):
+				fresh = anchorSplit.compare( x, [ sides[n] for n in missing ] )
+			else:
+				fresh = [ list( self.differ.compareToBase(x, sides[n]) ) for n in missing ]
+			for n, diff in zip(missing, fresh):
+				diffs[n] = diff
+		
+		if state and self.objType:
+			state.record( self.objType, diffs )
+		return diffs
+	
+	def _moves(self, diff):
+		'''Elements a diff both removes and adds, i.e. moved ones (when move detection is on)'''
+		if not self.differ.detectMoves:
+			return set()
+		removed = set( [ item[2:] for item in diff if item.startswith( self.marker.remove ) ] )
+		return removed.intersection( [ item[2:] for item in diff if item.startswith( self.marker.add ) ] )
+	
+	refFinder = re.compile( r'^H=([^\r\n]*)', re.M )
+	
+	def _identity(self, element):
+		'''The H value identifying an element across its versions, None if it has none'''
+		found = self.refFinder.search(element)
+		return found and found.group(1) or None
+	
+	def _carryMoves(self, diffs, names):
+		'''Carry the changes other sides made to moved elements over to where they were
+		   moved: an element another side deleted is dropped from its new place, one it
+		   edited (same H value) comes out in its edited form there, and not at the old
+		   place.  Returns the new diffs and the elements each side moved.  An element
+		   another side touched in a way that cannot be carried over (no H value to pair
+		   the versions by, or different edits by several sides) is not treated as moved,
+		   so the conflict there goes to the conflict manager.'''
+		moved = [ self._moves(diff) for diff in diffs ]
+		if not [ elements for elements in moved if elements ]:
+			return diffs, moved
+		
+		removed = [ set( [ item[2:] for item in diff if item.startswith( self.marker.remove ) ] ) for diff in diffs ]
+		added = [ [ item[2:] for item in diff if item.startswith( self.marker.add ) ] for diff in diffs ]
+		#per side: added element -> the element to add instead (None to leave it out)
+		replace = [ {} for diff in diffs ]
+		for n in range( len(diffs) ):
+			for element in list( moved[n] ):
+				versions = []
+				for t in range( len(diffs) ):
+					if t == n or not element in removed[t] or element in added[t]:
+						continue
+					identity = self._identity(element)
+					edited = [ other for other in added[t] if identity and self._identity(other) == identity ]
+					versions.append( (t, identity, edited[:1]) )
+				if not versions:
+					continue
+				if len(versions) > 1 or not versions[0][1]:
+					moved[n].discard(element)
+					continue
+				t, identity, edited = versions[0]
+				if edited:
+					replace[n][element] = self._preprocessAdd( edited[0], names[t] )
+					replace[t][ edited[0] ] = None
+					moved[n].add( replace[n][element] )
+				else:
+					replace[n][element] = None
+		
+		carried = []
+		for n in range( len(diffs) ):
+			diff = []
+			for item in diffs[n]:
+				if item.startswith( self.marker.add ) and replace[n].has_key( item[2:] ):
+					if replace[n][ item[2:] ] is not None:
+						diff.append( self.marker.add + replace[n][ item[2:] ] )
+				else:
+					diff.append(item)
+			carried.append(diff)
+		return carried, moved
+	
+	def _onlyMoves(self, items, moved):
+		changes = [ item for item in items if not item.startswith( self.marker.same ) ]
+		return changes and moved and not [ item for item in changes if not item[2:] in moved ]
+	
+	def _baseCount(self, items):
+		'''How many base elements a stretch of Differ output covers'''
+		return len( [ item for item in items if not item.startswith( self.marker.add ) ] )
+	
+	def _applyBoth(self, items_a, items_b, a_name, b_name):
+		'''Apply both sides' changes over the same stretch of the base:
+		   their additions, and the base elements neither side removed'''
+		removed = set( [ item[2:] for item in items_a + items_b if item.startswith( self.marker.remove ) ] )
+		m = []
+		kept = set()
+		for items, name in ( (items_a, a_name), (items_b, b_name) ):
+			for item in items:
+				if item.startswith( self.marker.add ):
+					m.append( self._preprocessAdd(item[2:], name) )
+				elif item.startswith( self.marker.same ) and not item[2:] in removed and not item[2:] in kept:
+					kept.add( item[2:] )
+					m.append( item[2:] )
+		return m
+	
+	#split a diff against the base into the elements each side adds in front of
+	#every base element (adds) and whether the base element was kept (kept)
+	def _alignToBase(self, x, diff):
+		adds = [ [] for i in range(len(x) + 1) ]
+		kept = [ True ] * len(x)
+		pos = 0
+		for item in diff:
+			status = item[:2]
+			if status == self.marker.add:
+				adds[pos].append( item[2:] )
+			elif status == self.marker.same:
+				pos += 1
+			elif status == self.marker.remove:
+				kept[pos] = False
+				pos += 1
+		return adds, kept
+	
+	#perform an n-way (octopus) merge of several sides against a single base
+	def nWay(self, sides, x, names=False):
+		'''Generalized threeWay.  The base is diffed once against every side and all
+		   of the alignments are walked together, one base element at a time.'''
+		if not names:
+			names = sideNames( len(sides) )
+		with profile.phase('diff'):
+			diffs = self._sideDiffs(x, sides)
+		diffs, moved = self._carryMoves(diffs, names)
+		aligned = [ self._alignToBase(x, diff) for diff in diffs ]
+		return self._walkAligned( x, aligned, names, moved, [ '' ] * len(sides) )
+	
+	def _walkAligned(self, x, aligned, names, moved, firstStatus):
+		'''Merge the sides aligned to base x, one base element at a time.
+		   firstStatus is the status of each side before x starts.'''
+		m = []
+		had_conflict = False
+		
+		for pos in range( len(x) + 1 ):
+			#status of the previous base element on each side, used by the conflict managers
+			if pos:
+				lastStatus = [ (kept[pos-1] and self.marker.same) or self.marker.remove for adds, kept in aligned ]
+			else:
+				lastStatus = firstStatus
+			
+			#collect the additions in front of this base element, identical additions only count once
+			additions = []
+			for n in range( len(aligned) ):
+				added = aligned[n][0][pos]
+				if added and not added in [ other for other_n, other in additions ]:
+					additions.append( (n, added) )
+			
+			if len(additions) == 1:
+				n, added = additions[0]
+				m.extend( [ self._preprocessAdd( element, names[n] ) for element in added ] )
+			
+			elif additions:
+				resolved, cm = self._mergeAdditions( additions, names, lastStatus, moved )
+				m.extend(cm)
+				if not resolved:
+					had_conflict = True
+			
+			#the base element survives only if no side removed it
+			if pos < len(x) and not False in [ kept[pos] for adds, kept in aligned ]:
+				m.append( x[pos] )
+		
+		return had_conflict, m
+	
+	def _mergeAdditions(self, additions, names, lastStatus, moved):
+		'''Merge conflicting additions made by several sides at the same spot'''
+		first_n, first = additions[0]
+		
+		# objects moved here by a side are not a conflict, keep every side's additions
+		if [ n for n, added in additions if self._onlyMoves( [ self.marker.add + element for element in added ], moved[n] ) ]:
+			m = []
+			for n, added in additions:
+				m.extend( [ self._preprocessAdd( element, names[n] ) for element in added ] )
+			return True, m
+		
+		# attempt last ditch merge element by element when all sides added the same count
+		if not [ added for n, added in additions if len(added) <> len(first) ]:
+			merged = list(first)
+			for n, added in additions[1:]:
+				for i in range( len(merged) ):
+					with profile.object( 'merge', added[i] ):
+						merged[i] = self._lastDitchMerge( merged[i], added[i], names[first_n], names[n] )
+				if False in merged:
+					break
+			else:
+				return True, merged
+		
+		# conflict - fold every side into the conflict manager in turn
+		resolved = True
+		m = [ self._preprocessAdd( element, names[first_n] ) for element in first ]
+		for n, added in additions[1:]:
+			cb = [ self._preprocessAdd( element, names[n] ) for element in added ]
+			sideResolved, m = self._resolveConflict( m, cb, (lastStatus[first_n], lastStatus[n]) )
+			resolved = resolved and sideResolved
+		return resolved, m
+	
 	#perform a last attempt to merge the line before calling the conflict manager (stub)
-	def _lastDitchMerge(self, element_a, element_b):
+	def _lastDitchMerge(self, element_a, element_b, a_name='A', b_name='B'):
 		return False
 	
+	def _resolveConflict(self, a, b, lastStatus):
+		'''Call the conflict manager, replaying a recorded resolution from the merge cache if there is one'''
+		if not cache:
+			return self._conflictManager(a, b, lastStatus)
+		
+		key = cache.key( self.__class__.__name__, lastStatus[0], lastStatus[1], contentKey(a), contentKey(b) )
+		found = cache.get('resolution', key)
+		if found is not None:
+			logging.info( 'Replaying recorded conflict resolution ' + key )
+			return found
+		resolved, m = self._conflictManager(a, b, lastStatus)
+		#only real resolutions are replayed, a conflict manager that gave up has to run (and warn) again
+		if resolved and not self.lossy:
+			cache.put( 'resolution', key, (resolved, list(m)) )
+		return resolved, m
+	
 	#preprocess an element before adding it to the final entity (stub)
 	def _preprocessAdd(self, element, sourceName):
 		return element
@@ -243,6 +1121,8 @@ class MergeConservative( Merge ):
 		return True, b
 
 class MergeGreedy( Merge ):
+	greedyAdds = True
+	
 	def _conflictManager(self, a, b, lastStatus):
 		'''Return the sum of all a and b.'''
 		m = []
@@ -262,9 +1142,9 @@ class SMWMerger():
 		result = self.childFinder.sub( r'\1-' + sourceName + '=', result )
 		return result
 		
-	def _lastDitchMerge(self, element_a, element_b):
+	def _lastDitchMerge(self, element_a, element_b, a_name='A', b_name='B'):
 		# try a line-by-line merge and verify the result is still a legal SMW object		
-		result = newline.join( self.twoWay( element_a.split(newline), element_b.split(newline) ) )
+		result = newline.join( self.twoWay( element_a.split(newline), element_b.split(newline), a_name, b_name ) )
 		try:
 			smwObject(result)
 			return result
@@ -279,22 +1159,22 @@ class SMWMergeGreedy( SMWMerger, MergeGreedy ):
 	pass
 
 class MergeMaxKeys( Merge ):
-	def _lastDitchMerge(self, element_a, element_b):
+	def _lastDitchMerge(self, element_a, element_b, a_name='A', b_name='B'):
 		# perform a line-by-line merge and keep the highest value keys
 		# will always return a completed result
-		result = self.twoWay( element_a.split(newline), element_b.split(newline) )
+		result = self.twoWay( element_a.split(newline), element_b.split(newline), a_name, b_name )
 		final = []
 		
 		last = ('', '')
 		for line in result:
-			current = result[line].split('=',1)
+			current = line.split('=',1)
 			if current[0] == last[0]:
 				if current[1] > last[1]:
-					final[-1] = current
+					final[-1] = line
 				else:
 					pass
 			else:
-				final.append( result[line] )
+				final.append( line )
 				
 			last = current
 		
@@ -305,6 +1185,8 @@ class MergeMaxKeys( Merge ):
 		raise NotImplementedError('MergeMaxKeys somehow fell to the Conflict Manager.')
 		
 class MergeSymbols( SMWMerger, Merge ):
+	greedyAdds = True
+	
 	def _conflictManager(self, a, b, lastStatus):
 		logging.debug( 'at MergeSymbols._conflictManager\n - len(a)=' + str(len(a)) + ' len(b)=' + str(len(b)) )
 		logging.debug(' - lastStatus='+str(lastStatus) )
@@ -325,6 +1207,7 @@ class MergeSymbols( SMWMerger, Merge ):
 		tkMessageBox.showerror("SMW Merge Error", "Unhandled merge conflict in the symbol library.\n\nResulting program will be incomplete.")
 		# TODO! check if there's a folder.  If it is, add comment with one of the folder names and use the other
 		# if not, create conflict folder
+		self.lossy = True
 		return True, []
 		
 
@@ -470,7 +1353,11 @@ class smwObject:
 		self.HA = self.getKey(smw.key.refA)
 		self.HB = self.getKey(smw.key.refB)
 		
-		self.refs = {'':self.H, 'A':self.HA, 'B':self.HB}
+		#refs holds the H value for each source, keyed by source tag ('' for untagged)
+		self.refs = {'':self.H}
+		for refKey in self._data:
+			if self._data[refKey].key == smw.key.ref and self._data[refKey].source:
+				self.refs[ self._data[refKey].source ] = str( self._data[refKey] )
 		
 		self.isParent = False
 		
@@ -576,10 +1463,10 @@ class smwObject:
 		
 		self.H = str(value)
 	
-	def fixSignals(self, signalTable):
-		'''Turn all inputs and outputs from H references to signal names for easier diff'''
+	def signalSlots(self):
+		'''The input and output keys (I# and O#) of a symbol'''
+		slots = []
 		if self.type == smw.type.symbol:
-			#inputCount = int(self.data['mI'])
 			for key in self._data:
 				try:
 					#find valid I5 or O10 kind of keys
@@ -587,14 +1474,21 @@ class smwObject:
 				except:
 					c = False
 				
-				if c:
-					#if this is an input or output (I# or O#)
-					if key[:1] in ['I', 'O']:
-						#replace the ref value with name from signal table
-						sigRef = self.getKey( key )
-						#sigName = self.references[smw.type.signal][sigRef].name
-						sigName = signalTable[sigRef].name
-						self.setKey( key, sigName )
+				#if this is an input or output (I# or O#)
+				if c and key[:1] in ['I', 'O']:
+					slots.append(key)
+		return slots
+	
+	def fixSignals(self, signalTable, signalUsage=None):
+		'''Turn all inputs and outputs from H references to signal names for easier diff'''
+		for key in self.signalSlots():
+			#replace the ref value with name from signal table
+			sigRef = self.getKey( key )
+			#sigName = self.references[smw.type.signal][sigRef].name
+			sigName = signalTable[sigRef].name
+			self.setKey( key, sigName )
+			if signalUsage is not None:
+				signalUsage.add( sigName, self, key )
 #			 			try:
 # 							self.setKey( key, self.references[smw.type.signal][int(self.data[key])].name )
 # 						except KeyError:
@@ -624,28 +1518,35 @@ class diffObject( smwObject ):
 		self.isParent = True
 		self.setKey( smw.key.childCount, len(self.children) )  #count of children
 			
-	def fixSignals(self, signalBackTable):
+	def fixSignals(self, signalBackTable, signalUsage=None):
 		'''Turn all inputs and outputs from signal names to H references'''
-		if self.type == smw.type.symbol:
-			#inputCount = int(self.data['mI'])
-			for key in self._data:
-				try:
-					#find valid I5 or O10 kind of keys
-					c = int(key[1:])
-				except:
-					c = False
-				
-				if c:
-					#if this is an input or output (I# or O#)
-					if key[:1] in ['I', 'O']:
-						#replace the name with the ref value from the back signal table
-						sigName = self.getKey(key)
-						#print self.name, key, sigName
-						#sigObj = self.references['back-'+smw.type.signal][ sigName ]
-						sigObj = signalBackTable[ sigName ]
-						self.setKey(key, sigObj.H )
-						#if this signal is used, make sure it isn't hidden
-						sigObj.hidden = False
+		for key in self.signalSlots():
+			#replace the name with the ref value from the back signal table
+			sigName = self.getKey(key)
+			#sigObj = self.references['back-'+smw.type.signal][ sigName ]
+			sigObj = signalBackTable[ sigName ]
+			self.setKey(key, sigObj.H )
+			if signalUsage is not None:
+				signalUsage.add( sigName, self, key )
+
+class signalIndex:
+	'''Inverted index of signal usage: signal name -> set of (symbol, slot) using it,
+	   the slot being the symbol's I# or O# key.  Saves scanning every symbol to find
+	   the users of a signal.'''
+	def __init__(self):
+		self.uses = {}
+	
+	def add(self, name, symbol, slot):
+		self.uses.setdefault( name, set() ).add( (symbol, slot) )
+	
+	def addSymbol(self, symbol):
+		'''Index a symbol whose inputs and outputs hold signal names'''
+		for slot in symbol.signalSlots():
+			self.add( symbol.getKey(slot), symbol, slot )
+	
+	def whereUsed(self, name):
+		'''The (symbol, slot) pairs using a signal, in symbol then slot order'''
+		return sorted( self.uses.get(name, ()), key=lambda use: (use[0].name, use[0].H, use[1][:1], int(use[1][1:])) )
 
 class inFile:
 	'''Splits a data stream containing SMW objects and makes them ready for diff'ing'''
@@ -656,6 +1557,8 @@ class inFile:
 		'3': obj( newline.join([smw.key.type+'='+smw.type.signal, 'H=3', 'Nm=Local']) )
 		}
 	firstSignal = 4
+	#what reading the objects is profiled as (--profile)
+	readKind = 'parse'
 	
 	def __init__(self, data):
 		self.objOrder = []
@@ -663,6 +1566,8 @@ class inFile:
 		self.objList = {}
 		
 		self.references[ smw.type.signal ] = dict(self.reservedSignals)
+		#signal name -> symbols using it
+		self.signalUsage = signalIndex()
 		
 		self.readData(data)
 
@@ -675,7 +1580,11 @@ class inFile:
 		for chunk in chunks:
 			if not chunk:
 				continue
+			if profile.enabled:
+				started = time.time()
 			newObj = self.obj(chunk)
+			if profile.enabled:
+				profile.addObject( self.readKind, newObj.type, newObj.name or newObj.H, time.time() - started )
 			#self.data.append(newObj)
 			
 			if not newObj.type in self.objOrder:
@@ -694,9 +1603,11 @@ class inFile:
 		
 		
 		# self.references[ symbol ]  is a dict
+		#a file may have no symbols (or they are not merged, see --types)
 		signalTable = self.references[ smw.type.signal ]
-		for key in self.references[ smw.type.symbol ]:
-			self.references[ smw.type.symbol ][key].fixSignals(signalTable)
+		symbols = self.references.get( smw.type.symbol, {} )
+		for key in symbols:
+			symbols[key].fixSignals(signalTable, self.signalUsage)
 	
 	def addReferences( self, newObj ):
 		#if we have a ref (H), store ref in the lists (as dict)
@@ -749,14 +1660,105 @@ class inFile:
 				out.append( str(obj) )
 		
 		return out
+	
+	def freeze(self):
+		'''Return a frozenFile snapshot of this file, shareable between merges'''
+		return frozenFile(self)
+	
+	def compact(self):
+		'''The object type order and the diff strings of every type, all the merge needs.
+		   Cheap to pass between processes, unlike the object graph.'''
+		strings = {}
+		for objType in self.objOrder:
+			strings[objType] = self.diffOut(objType)
+		return self.objOrder, strings
+
+
+class frozenFile( inFile ):
+	'''Read-only snapshot of a parsed file that any number of merges can use at once.
+	   The merges only read the base, so the objects are shared with the source file;
+	   the diff strings of each type are rendered once and shared as well.'''
+	def __init__(self, source):
+		self.objOrder = source.objOrder
+		self.objList = source.objList
+		self.references = source.references
+		self.signalUsage = source.signalUsage
+		self._diffOut = {}
+	
+	def readData(self, data):
+		raise SMWError( "Cannot read data into a frozen SMW file" )
+	
+	def diffOut(self, objType):
+		if not self._diffOut.has_key(objType):
+			self._diffOut[objType] = inFile.diffOut(self, objType)
+		return list( self._diffOut[objType] )
+	
+	def freeze(self):
+		return self
+
+
+class parsedFile( inFile ):
+	'''An inFile rebuilt from the compact() form returned by a parsing process.
+	   The diff strings are used as they are; the objects are only recreated
+	   from them if something asks for objList or references.'''
+	#the diff strings are already in the form diffObject reads
+	obj = diffObject
+	
+	def __init__(self, compact):
+		self.objOrder, self.strings = compact
+	
+	def diffOut(self, objType):
+		return list( self.strings.get(objType, []) )
+	
+	def __len__(self):
+		return sum( [ len(strings) for strings in self.strings.values() ] )
+	
+	def freeze(self):
+		#the diff strings can already be shared
+		return self
+	
+	def __getattr__(self, name):
+		if name == 'signalUsage':
+			#the symbols already hold signal names
+			self.signalUsage = signalIndex()
+			for symbol in self.references.get( smw.type.symbol, {} ).values():
+				self.signalUsage.addSymbol(symbol)
+			return self.signalUsage
+		if not name in ('objList', 'references'):
+			raise AttributeError(name)
+		self.objList = {}
+		self.references = {}
+		self.references[ smw.type.signal ] = dict(self.reservedSignals)
+		for objType in self.objOrder:
+			self.objList[objType] = []
+			for string in self.strings[objType]:
+				newObj = self.obj(string)
+				self.addReferences( newObj )
+				self.objList[objType].append(newObj)
+		return getattr(self, name)
 
 
 class outFile( inFile ):
 	'''Takes a list of SMW Objects and turns them back into a legal SMW file'''
-	def __init__(self, data):
+	#how colliding H values are resolved: 'bump' increments them, 'dense' keeps the base
+	#H values and numbers new objects compactly after them (see denseRefs)
+	renumber = 'bump'
+	#reading the merged objects back is part of building the output, not parsing input
+	readKind = 'output'
+	
+	def __init__(self, data, sides=sideNames(2), baseRefs=None):
 		self.objOrder = []
 		self.references = {}
 		self.objList = {}
+		self.sides = sides
+		#type -> H value -> base object string, for dense renumbering
+		self.baseRefs = baseRefs or {}
+		#H values chosen by an earlier merge (--state) and by this one, by type then 'side:ref'
+		self.previousRefs = ( state and state.previous.get('refs') ) or {}
+		self.chosenRefs = {}
+		#signal name -> symbols using it, and signal name -> signal object
+		self.signalUsage = signalIndex()
+		self.signalBackTable = {}
 		
 		self.buildRefTables( smw.type.signal, dict(self.reservedSignals) )
 		
@@ -769,8 +1771,8 @@ class outFile( inFile ):
 	def buildRefTables( self, type, base={} ):
 		self.references[type] = {}
 		self.references[type][''] = base
-		#build the A and B redirected dict.  Any failed lookups in A or B will try the base
-		for file in ['A', 'B']:
+		#build the A, B (etc.) redirected dict.  Any failed lookups in a side will try the base
+		for file in self.sides:
 			self.references[type][file] = redict()
 			self.references[type][file].setBase(base)
 		
@@ -778,14 +1780,10 @@ class outFile( inFile ):
 	#override the addReferences routine
 	def addReferences( self, newObj ):
 		#if the object has an H value, fix it and save a reference
-		if newObj.H or newObj.HA or newObj.HB:
+		if [ ref for ref in newObj.refs.values() if ref ]:
 			#if there is no array for this object type, create one
 			if not self.references.has_key(newObj.type):
 				self.buildRefTables( newObj.type )
-			
-			#assume all signals are hidden until referenced otherwise
-			if newObj.type == smw.type.signal:
-				newObj.hidden = True
 
 # done in build forward references			
 # 			for file in ['', 'A', 'B']:
@@ -809,11 +1807,16 @@ class outFile( inFile ):
 # 				
 # 		self.objList[ smw.type.symbol ] = topSymbols + otherSymbols
 	
+	#the object types being merged when only some are (--types), references into the others are kept as they are
+	merged = None
+	
 	def correctObjectCrossRef( self, obj, list, key ):
 		'''Corrects a given cross ref.
 		   obj is the object to modify
 		   list is the list where we look up the value
 		   key is the obj key we use to perform the lookup'''
+		if self.merged is not None and not list in self.merged:
+			return
 		#look in this file:
 		try:
 			file = obj.getKeySource( key )
@@ -838,6 +1841,17 @@ class outFile( inFile ):
 		#set our ref to that object's H value
 		obj.setKey( key, refObj.H )
 	
+	def pruneSignals( self ):
+		'''Hide the signals that no symbol uses'''
+		#symbols copied unmerged (--types) use signals this file does not know about
+		if self.merged is not None and not smw.type.symbol in self.merged:
+			return
+		for obj in self.objList.get( smw.type.signal, [] ):
+			if [ ref for ref in obj.refs.values() if ref ]:
+				obj.hidden = True
+		for name in self.signalUsage.uses:
+			self.signalBackTable[name].hidden = False
+	
 	def correctAllCrossRefs( self ):
 		'''Steps through all objects and corrects the cross references.
 		   depends on an accurate references table.'''
@@ -886,14 +1900,24 @@ class outFile( inFile ):
 			pass
 		
 		H = ''
-		# try and register this object with the original ref, then the B ref, then A
-		for Href in [ '', 'B', 'A' ]:
-			H = obj.refs[Href]
+		order = [ '' ] + self.sides[::-1]
+		
+		# prefer the H value an earlier merge of the same inputs chose for this object
+		previous = self.previousRefs.get(ref, {})
+		for Href in order:
+			H = previous.get( Href + ':' + obj.refs.get(Href, '') )
+			if H and not refList.has_key( H ):
+				refList[ H ] = obj
+				return H
+		
+		# try and register this object with the original ref, then the last side's ref (B), then earlier ones (A)
+		for Href in order:
+			H = obj.refs.get(Href, '')
 			if not refList.has_key( H ):
 				refList[ H ] = obj
 				return H
 		
-		H = obj.H or obj.HB or obj.HA
+		H = [ obj.refs.get(Href) for Href in order if obj.refs.get(Href) ][0]
 		# if we have failed to find a spot (likely due to a conflict), increment until we find one
 		# (could instead look at the highest match, but that may not fill in holes properly)
 		while refList.has_key( H ):
@@ -908,21 +1932,80 @@ class outFile( inFile ):
 		
 		
 	
+	def denseRefs( self, ref ):
+		'''Choose the H values of all objects of a type at once: an object that has the H
+		   value of a base object keeps it (of several claiming one, the object closest to
+		   that base object does), every other object is numbered after the highest base H
+		   value, by source ('' then the sides in order) and then in list order.  Returns
+		   the H value for each object.'''
+		baseRefs = self.baseRefs.get(ref, {})
+		claims = {}
+		for obj in self.objList.get(ref, []):
+			for Href in [ '' ] + self.sides:
+				H = obj.refs.get(Href)
+				if H and H in baseRefs:
+					claims.setdefault( H, [] ).append(obj)
+		
+		chosen = {}
+		taken = set()
+		for obj in self.objList.get(ref, []):
+			for Href in [ '' ] + self.sides:
+				H = obj.refs.get(Href)
+				if H and H in baseRefs and not H in taken and obj is self.closestTo( baseRefs[H], claims[H] ):
+					chosen[ id(obj) ] = H
+					taken.add(H)
+					break
+		
+		numbers = [ 0 ]
+		for H in baseRefs:
+			try:
+				numbers.append( int(H) )
+			except ValueError:
+				numbers.append( int( float(H) ) )
+		if ref == smw.type.signal:
+			numbers.append( self.firstSignal - 1 )
+		nextH = max(numbers) + 1
+		
+		for Href in [ '' ] + self.sides:
+			for obj in self.objList.get(ref, []):
+				if chosen.has_key( id(obj) ) or not obj.refs.get(Href):
+					continue
+				chosen[ id(obj) ] = str(nextH)
+				nextH += 1
+		return chosen
+	
+	def closestTo( self, element, objects ):
+		'''The object most like the base object string element (the first one on a tie)'''
+		if len(objects) == 1:
+			return objects[0]
+		tagged = re.compile( '^([^=\r\n]*)-(?:' + '|'.join( [ re.escape(side) for side in self.sides ] ) + ')=', re.M )
+		best, bestRatio = None, -1
+		for obj in objects:
+			ratio = difflib.SequenceMatcher( None, element, tagged.sub( r'\1=', str(obj) ) ).ratio()
+			if ratio > bestRatio:
+				best, bestRatio = obj, ratio
+		return best
+	
 	def buildForwardReference( self, ref ):
 		'''Build a forward reference table, creating or updating the H values as needed'''
 # 		H = 1
 # 		if ref == smw.type.signal:
 # 			H = self.firstSignal
-			
-		for obj in self.objList[ref]:
+		
+		dense = {}
+		if self.renumber == 'dense':
+			dense = self.denseRefs(ref)
+		
+		for obj in self.objList.get(ref, []):
 			#get a unique ref for this obj
-			newH = self.getUniqueRef( ref, obj )
+			newH = dense.get( id(obj) ) or self.getUniqueRef( ref, obj )
 			
 			#register this object with its different lists based on its original refs (for lookup)
-			for file in ['', 'A', 'B']:
-				if obj.refs[file]:
+			for file in [ '' ] + self.sides:
+				if obj.refs.get(file):
 					logging.debug( ref +' '+ file +' '+ obj.refs[file] + ' -> ' + newH )
 					self.references[ref][file][ obj.refs[file] ] = obj
+					self.chosenRefs.setdefault( ref, {} )[ file + ':' + obj.refs[file] ] = newH
 			#set the new unique ref (for output)
 			obj.setRef( newH )
 			
@@ -1006,39 +2089,977 @@ class outFile( inFile ):
 #			self.recreateParentage()
 #			self.correctSymbolArrangement()
 		
-		for smwType in self.references:
-			self.buildForwardReference( smwType )
+		with profile.phase('buildForwardReference'):
+			for smwType in self.references:
+				self.buildForwardReference( smwType )
 		
 		global signalBackTable
 		signalBackTable = self.buildBackReference( self.references[smw.type.signal][''] )
-		signalBackTable = self.buildBackReference( self.references[smw.type.signal]['A'], signalBackTable )
-		signalBackTable = self.buildBackReference( self.references[smw.type.signal]['B'], signalBackTable )
+		for file in self.sides:
+			signalBackTable = self.buildBackReference( self.references[smw.type.signal][file], signalBackTable )
 		# Re-encode the signal references in the symbol objects
 		#signalBackTable = self.references[ 'back-' + smw.type.signal ]
 		
-		if self.objList.has_key( smw.type.symbol ):
-			for obj in self.objList[ smw.type.symbol ]:
-				obj.fixSignals(signalBackTable)
+		self.signalBackTable = signalBackTable
+		
+		with profile.phase('fixSignals'):
+			if self.objList.has_key( smw.type.symbol ):
+				for obj in self.objList[ smw.type.symbol ]:
+					obj.fixSignals(signalBackTable, self.signalUsage)
+			self.pruneSignals()
 				
 #			self.rebuildFolderReferences()
 		
-		self.correctAllCrossRefs()
+		with profile.phase('correctAllCrossRefs'):
+			self.correctAllCrossRefs()
 
 	
 	
+	def renderType(self, objType):
+		'''The serialized objects of one type'''
+		out = []
+		for obj in self.objList.get(objType, []):
+			if not obj.hidden:
+				serialized = str(obj)
+				if(serialized):
+					out.append( serialized )
+		return out
+	
 	def __str__(self):
 		out = []
 		#step through all objects and add
 		for objType in self.objOrder:
-			for obj in self.objList[objType]:
-				if not obj.hidden:
-					serialized = str(obj)
-					if(serialized):
-						out.append( serialized )
+			out.extend( self.renderType(objType) )
 		
 		
 		return newline.join(out)
 
+########################################################
+##
+##   Symbol folders
+##
+########################################################
+
+class folderTree:
+	'''The folder tree of the symbols in a parsed file, linked through C# child keys,
+	   with a Merkle hash for every subtree'''
+	def __init__(self, symbols, strings):
+		#the symbol objects and their diff strings (diffOut), in file order
+		self.symbols = symbols
+		self.strings = strings
+		self.byH = {}
+		self.position = {}
+		for pos in range( len(symbols) ):
+			self.byH[ symbols[pos].H ] = symbols[pos]
+			self.position[ symbols[pos].H ] = pos
+		self.hashes = {}
+		self.members = {}
+		for obj in symbols:
+			self.merkle(obj, [])
+	
+	def children(self, obj):
+		return [ self.byH[ str(child) ] for child in obj.children if self.byH.has_key( str(child) ) ]
+	
+	def merkle(self, obj, path):
+		'''Hash of the object and, for folders, of all of its children'''
+		if self.hashes.has_key(obj.H):
+			return self.hashes[obj.H]
+		h = hashlib.sha1( self.strings[ self.position[obj.H] ] )
+		members = [ self.position[obj.H] ]
+		for child in self.children(obj):
+			#a corrupt file could loop
+			if child.H in path:
+				continue
+			h.update( self.merkle(child, path + [obj.H]) )
+			members.extend( self.members[child.H] )
+		self.hashes[obj.H] = h.hexdigest()
+		self.members[obj.H] = members
+		return self.hashes[obj.H]
+	
+	def span(self, H):
+		'''The (first, last) list position of the subtree, or None if it is not contiguous'''
+		members = self.members[H]
+		if max(members) - min(members) + 1 <> len(members):
+			return None
+		return min(members), max(members)
+
+
+def collapseFolders(trees):
+	'''Replace every folder subtree that is identical (same Merkle hash) and contiguous in all
+	   the given folderTrees with a single placeholder, so the symbol diff skips it.
+	   Returns the collapsed symbol lists and the placeholder expansions.'''
+	expansions = {}
+	spans = [ [] for tree in trees ]
+	base = trees[-1]
+	
+	def walk(obj):
+		if not obj.isParent:
+			return
+		H = obj.H
+		found = [ tree.hashes.get(H) == base.hashes[H] and tree.span(H) for tree in trees ]
+		if not False in found and not None in found:
+			first, last = found[-1]
+			placeholder = '<folder ' + base.hashes[H] + '>'
+			expansions[placeholder] = base.strings[first:last + 1]
+			for n in range( len(trees) ):
+				spans[n].append( found[n] + (placeholder,) )
+			return
+		#this folder changed somewhere, look at its children
+		for child in base.children(obj):
+			walk(child)
+	
+	for obj in base.symbols:
+		if not obj.parent:
+			walk(obj)
+	
+	lists = []
+	for n in range( len(trees) ):
+		out = list( trees[n].strings )
+		for first, last, placeholder in sorted( spans[n], reverse=True ):
+			out[first:last + 1] = [ placeholder ]
+		lists.append(out)
+	return lists, expansions
+
+def expandFolders(result, expansions):
+	'''Undo collapseFolders on a merge result'''
+	out = []
+	for element in result:
+		if expansions.has_key(element):
+			out.extend( expansions[element] )
+		else:
+			out.append(element)
+	return out
+
+
+########################################################
+##
+##   Verification
+##
+########################################################
+
+class verifier:
+	'''Checks the internal cross references of a complete SMW file in a single indexed pass'''
+	slotFinder = re.compile( '^(C|I|O)([0-9]+)$' )
+	nullRefs = [ '', '0' ]
+	
+	def __init__(self, data):
+		self.problems = []
+		#every H value by object type
+		self.index = {}
+		#every reference found, checked against the index once it is complete
+		self.refs = []
+		
+		if type(data) == type(''):
+			chunks = data.split(newline+']'+newline)
+		else:
+			chunks = data
+		
+		for chunk in chunks:
+			self.indexObject( chunk )
+		self.checkRefs()
+	
+	def __len__(self):
+		return len(self.problems)
+	
+	def __iter__(self):
+		return self.problems.__iter__()
+	
+	def problem(self, objType, H, message):
+		self.problems.append( objType + ' ' + (H or '?') + ': ' + message )
+	
+	def indexObject(self, chunk):
+		data = {}
+		children = 0
+		slots = []
+		for line in chunk.split(newline):
+			key, sep, value = line.partition('=')
+			if not sep or data.has_key(key):
+				continue
+			data[key] = value
+			slot = self.slotFinder.match(key)
+			if slot:
+				if slot.group(1) == 'C':
+					children += 1
+				slots.append( (slot.group(1), key, value) )
+		
+		if not data.has_key( smw.key.type ):
+			return
+		objType = data[ smw.key.type ]
+		H = data.get( smw.key.ref, '' )
+		
+		#duplicate H values per type
+		if H:
+			typeIndex = self.index.setdefault( objType, {} )
+			if typeIndex.has_key(H):
+				self.problem( objType, H, 'duplicate H' )
+			typeIndex[H] = True
+		
+		#the child count must match the C# keys
+		if data.has_key( smw.key.childCount ) and str(children) <> data[ smw.key.childCount ]:
+			self.problem( objType, H, smw.key.childCount + '=' + data[ smw.key.childCount ] + ' but ' + str(children) + ' child keys' )
+		
+		if data.has_key( smw.key.parent ):
+			self.refs.append( (objType, H, smw.key.parent, objType, data[ smw.key.parent ]) )
+		for xref in smw.crossref:
+			if data.has_key( xref ):
+				self.refs.append( (objType, H, xref, smw.crossref[xref], data[xref]) )
+		for kind, key, value in slots:
+			if kind == 'C':
+				self.refs.append( (objType, H, key, objType, value) )
+			elif objType == smw.type.symbol:
+				self.refs.append( (objType, H, key, smw.type.signal, value) )
+	
+	def checkRefs(self):
+		signals = self.index.setdefault( smw.type.signal, {} )
+		for reserved in inFile.reservedSignals:
+			signals.setdefault( reserved, True )
+		
+		for objType, H, key, target, value in self.refs:
+			if value in self.nullRefs:
+				continue
+			if not self.index.get( target, {} ).has_key( value ):
+				self.problem( objType, H, 'dangling ' + key + ' -> ' + target + ' ' + value )
+		self.refs = []
+
+
+def verify(data, source):
+	'''Verify the given SMW data, logging any problems.  Returns the count of problems.'''
+	problems = verifier(data)
+	for problem in problems:
+		logging.error( source + ': ' + problem )
+	logging.info( source + ': verify found ' + str(len(problems)) + ' problem(s)' )
+	return len(problems)
+
+########################################################
+##
+##   Merge cache
+##
+########################################################
+
+class mergeCache:
+	'''Persistent content-addressed cache of merge results in a local directory.
+	   Holds whole-file results, per-type handler results and conflict resolutions, keyed
+	   by hashes of their inputs.  Least recently used entries are removed once the
+	   directory grows past maxSize bytes.'''
+	def __init__(self, path, maxSize):
+		self.path = path
+		self.maxSize = maxSize
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		#the results depend on the merge code, so a changed program never replays older results
+		self.code = self.sourceKey()
+	
+	@staticmethod
+	def sourceKey():
+		'''Hash of this program's source, the version number if it cannot be read'''
+		filename = os.path.splitext( os.path.abspath(__file__) )[0] + '.py'
+		try:
+			f = open(filename, 'rb')
+			source = f.read()
+			f.close()
+		except IOError:
+			return version
+		return contentKey( [source] )
+	
+	def key(self, *parts):
+		'''Hash the given strings (and the program's source) into a cache key'''
+		return contentKey( (version, self.code) + parts )
+	
+	def filename(self, kind, key):
+		return os.path.join( self.path, kind + '-' + key )
+	
+	def get(self, kind, key):
+		'''Return the stored value or None.  A hit marks the entry as recently used.'''
+		filename = self.filename(kind, key)
+		try:
+			f = open(filename, 'rb')
+			value = marshal.loads( zlib.decompress( f.read() ) )
+			f.close()
+		except (IOError, ValueError, EOFError, TypeError, zlib.error):
+			return None
+		try:
+			os.utime(filename, None)
+		except OSError:
+			pass
+		return value
+	
+	def put(self, kind, key, value):
+		filename = self.filename(kind, key)
+		temp = filename + '.' + str(os.getpid())
+		try:
+			f = open(temp, 'wb')
+			f.write( zlib.compress( marshal.dumps(value) ) )
+			f.close()
+			if os.path.exists(filename):
+				os.remove(filename)
+			os.rename(temp, filename)
+		except (IOError, OSError), err:
+			logging.warn( 'Could not write merge cache entry ' + filename + ': ' + str(err) )
+			return
+		self.evict()
+	
+	def evict(self):
+		'''Remove the least recently used entries until the cache fits in maxSize'''
+		entries = []
+		total = 0
+		for name in os.listdir(self.path):
+			try:
+				stat = os.stat( os.path.join(self.path, name) )
+			except OSError:
+				continue
+			entries.append( (stat.st_mtime, stat.st_size, name) )
+			total += stat.st_size
+		entries.sort()
+		while total > self.maxSize and entries:
+			mtime, size, name = entries.pop(0)
+			try:
+				os.remove( os.path.join(self.path, name) )
+				total -= size
+			except OSError:
+				pass
+
+cache = None
+
+
+def mergeType(mergeHandler, objType, lists, names):
+	'''Run mergeHandler over the side lists and the base list (last), through the merge cache when enabled.
+	   With --state every type is merged, so that its alignment is recorded for the next run.'''
+	useCache = cache and not state
+	if useCache:
+		key = cache.key( mergeHandler.__name__, 'moves ' + str(smwDiffer.detectMoves), *[ contentKey(l) for l in lists ] )
+		found = cache.get('type', key)
+		if found is not None:
+			objResult = mergeHandler()
+			objResult.conflict, objResult.result = found
+			objResult.ran = True
+			return objResult
+	
+	if len(lists) == 3:
+		objResult = mergeHandler( lists[0], lists[1], lists[2], objType=objType )
+	else:
+		objResult = mergeHandler( x=lists[-1], sides=lists[:-1], names=names, objType=objType )
+	
+	#results cut short by the diff budget, or missing what a conflict manager dropped, are not worth keeping
+	if useCache and not objResult.differ.fallbacks and not objResult.lossy:
+		cache.put( 'type', key, (objResult.conflict, list(objResult.result)) )
+	return objResult
+
+########################################################
+##
+##   Incremental merge state
+##
+########################################################
+
+def objectHash(element):
+	return hashlib.sha1(element).hexdigest()
+
+class mergeState:
+	'''Alignment state saved next to a merge result (--state), so that a later merge of
+	   mostly the same inputs only re-diffs the objects whose hashes changed.
+	   Holds, per object type, the base and side object hashes and the Differ marker
+	   streams (as [marker, base position, side position]), plus the H values chosen
+	   by outFile.buildForwardReference.
+	   Stored with marshal like the cache, so the object text stays byte strings.'''
+	def __init__(self, filename):
+		self.filename = filename
+		self.previous = {'types': {}, 'refs': {}}
+		if os.path.exists(filename):
+			try:
+				f = open(filename, 'rb')
+				self.previous = marshal.loads( zlib.decompress( f.read() ) )
+				f.close()
+			except (IOError, ValueError, EOFError, TypeError, zlib.error), err:
+				logging.warn( 'Ignoring unreadable merge state ' + filename + ': ' + str(err) )
+		self.types = {}
+		self.refs = {}
+		#hashes of the lists handed to reuse(), waiting for record()
+		self._pending = {}
+	
+	def reuse(self, objType, x, sides, differ):
+		'''Return the diff of x against each side rebuilt from the saved state, or None
+		   for the sides that have to be diffed from scratch'''
+		xHashes = [ objectHash(element) for element in x ]
+		sideHashes = [ [ objectHash(element) for element in side ] for side in sides ]
+		self._pending[objType] = (x, sides, xHashes, sideHashes)
+		
+		old = self.previous['types'].get(objType)
+		if not old or old['base'] <> xHashes:
+			return [ None ] * len(sides)
+		
+		diffs = []
+		for n in range( len(sides) ):
+			if n < len(old['sides']):
+				entries = self.patch( x, sides[n], sideHashes[n], old['sides'][n], differ )
+				diffs.append( self.lines(x, sides[n], entries) )
+			else:
+				diffs.append(None)
+		return diffs
+	
+	def record(self, objType, diffs):
+		x, sides, xHashes, sideHashes = self._pending.pop(objType)
+		self.types[objType] = {'base': xHashes,
+							   'sides': [ {'hashes': sideHashes[n], 'diff': self.entries(diffs[n])} for n in range( len(sides) ) ]}
+	
+	def entries(self, diff, xlo=0, slo=0):
+		'''Turn Differ output into [marker, base position, side position] entries'''
+		out = []
+		xi, si = xlo, slo
+		for line in diff:
+			status = line[:2]
+			if status == Merge.marker.same:
+				out.append( [status, xi, si] )
+				xi += 1
+				si += 1
+			elif status == Merge.marker.remove:
+				out.append( [status, xi, -1] )
+				xi += 1
+			elif status == Merge.marker.add:
+				out.append( [status, -1, si] )
+				si += 1
+		return out
+	
+	def lines(self, x, side, entries):
+		'''Turn entries back into Differ output (without the inline hints, which the merges ignore)'''
+		out = []
+		for status, xi, si in entries:
+			if status == Merge.marker.add:
+				out.append( status + side[si] )
+			else:
+				out.append( status + x[xi] )
+		return out
+	
+	def patch(self, x, side, sideHashes, old, differ):
+		'''Update a saved diff of the (unchanged) base against a changed side.
+		   Unchanged pairs in the old diff are kept as anchors; the stretches between
+		   anchors are reused if the side is the same there and re-diffed otherwise.'''
+		if old['hashes'] == sideHashes:
+			return old['diff']
+		
+		#old side position -> new side position, for the objects that did not change
+		moved = {}
+		matcher = difflib.SequenceMatcher( None, old['hashes'], sideHashes, autojunk=False )
+		for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+			if tag == 'equal':
+				for k in range(i2 - i1):
+					moved[i1 + k] = j1 + k
+		
+		entries = []
+		region = []
+		last = (-1, -1)
+		for status, xi, si in old['diff'] + [ [Merge.marker.same, len(x), -2] ]:
+			if status == Merge.marker.same and ( si == -2 or moved.has_key(si) ):
+				anchor = ( xi, moved.get(si, len(side)) )
+				self.patchRegion( x, side, region, last, anchor, moved, differ, entries )
+				if si <> -2:
+					entries.append( [status, xi, anchor[1]] )
+				last = anchor
+				region = []
+			else:
+				region.append( [status, xi, si] )
+		return entries
+	
+	def patchRegion(self, x, side, region, last, anchor, moved, differ, entries):
+		xlo, slo = last[0] + 1, last[1] + 1
+		xhi, shi = anchor
+		sideSteps = [ moved.get(si) for status, xi, si in region if si >= 0 ]
+		if sideSteps == range(slo, shi):
+			for status, xi, si in region:
+				entries.append( [status, xi, moved.get(si, -1)] )
+		else:
+			logging.debug( 'mergeState: re-diffing base ' + str(xlo) + '-' + str(xhi) + ' side ' + str(slo) + '-' + str(shi) )
+			entries.extend( self.entries( differ.compare(x[xlo:xhi], side[slo:shi]), xlo, slo ) )
+	
+	def save(self):
+		f = open(self.filename, 'wb')
+		f.write( zlib.compress( marshal.dumps( {'types': self.types, 'refs': self.refs} ) ) )
+		f.close()
+
+state = None
+
+
+########################################################
+##
+##   Selective merge
+##
+########################################################
+
+class typeSelection:
+	'''Merge only some object types (--types).  The files are split into objects by type
+	   without parsing them; the objects of the other types are copied byte for byte from
+	   one file (the passthrough side) and only their references into merged types are
+	   rewritten, where the merge gave the referenced object a different H.'''
+	objectFinder = re.compile( r'^\[\r\n.*?\r\n\]', re.M | re.S )
+	typeFinder = re.compile( '^' + smw.key.type + r'=([^\r\n]*)', re.M )
+	
+	def __init__(self, types, side):
+		self.types = set(types)
+		#symbols refer to signals by name while merging, they cannot be merged alone
+		if smw.type.symbol in self.types:
+			self.types.add( smw.type.signal )
+		#side tag of the passthrough file, '' for the base
+		self.side = side
+		#type -> raw objects of the passthrough file
+		self.raw = {}
+	
+	def split(self, text):
+		'''Return the type order of the text, the objects of the selected types
+		   (for inFile) and the objects of every other type, by type'''
+		order = []
+		selected = []
+		others = {}
+		for found in self.objectFinder.finditer(text):
+			chunk = found.group(0)
+			objType = self.typeFinder.search(chunk)
+			objType = objType and objType.group(1) or ''
+			if not objType in order:
+				order.append(objType)
+			if objType in self.types:
+				selected.append(chunk)
+			else:
+				others.setdefault( objType, [] ).append(chunk)
+		return order, selected, others
+	
+	def target(self, objType, key):
+		'''The object type a key of a raw object refers to, if it is a merged one'''
+		if smw.crossref.has_key(key):
+			target = smw.crossref[key]
+		elif objType == smw.type.symbol and key[:1] in ['I', 'O'] and key[1:].isdigit():
+			target = smw.type.signal
+		else:
+			return None
+		if target in self.types:
+			return target
+		return None
+	
+	def rewrite(self, objType, chunk, chosenRefs):
+		'''Point the references of a raw object at the H values the merge chose'''
+		lines = chunk.split(newline)
+		changed = False
+		for n in range( len(lines) ):
+			key, sep, value = lines[n].partition('=')
+			target = sep and self.target(objType, key)
+			if not target:
+				continue
+			chosen = chosenRefs.get(target, {})
+			H = chosen.get( self.side + ':' + value ) or chosen.get( ':' + value )
+			if H and H <> value:
+				lines[n] = key + '=' + H
+				changed = True
+		if not changed:
+			return chunk
+		return newline.join(lines)
+	
+	def render(self, o):
+		'''The merged objects and the passthrough objects, in the master type order'''
+		out = []
+		for objType in masterObjOrder:
+			if objType in self.types:
+				out.extend( o.renderType(objType) )
+			else:
+				out.extend( [ self.rewrite(objType, chunk, o.chosenRefs) for chunk in self.raw.get(objType, []) ] )
+		return newline.join(out)
+
+selection = None
+
+
+########################################################
+##
+##   Merge check
+##
+########################################################
+
+class mergeCheck:
+	'''Tell whether a merge would be clean without merging (--check).
+	   The objects of every file are indexed by type and identity (their H value, or their
+	   position for types without one) straight from the text.  Only objects that more than
+	   one side changed are looked at closer, with the last ditch merge of their type's
+	   merge handler; nothing is diffed and no output is built.'''
+	refFinder = re.compile( '^' + smw.key.ref + r'=([^\r\n]*)', re.M )
+	
+	def __init__(self, texts, names):
+		self.order = []
+		self.files = [ self.index(text) for text in texts ]
+		self.names = names
+		#(type, identity, side names) of every conflict found
+		self.conflicts = []
+	
+	def index(self, text):
+		'''type -> identity -> object text'''
+		objects = {}
+		for found in typeSelection.objectFinder.finditer(text):
+			chunk = found.group(0)
+			objType = typeSelection.typeFinder.search(chunk)
+			objType = objType and objType.group(1) or ''
+			if not objType in self.order:
+				self.order.append(objType)
+			identities = objects.setdefault( objType, {} )
+			H = self.refFinder.search(chunk)
+			identities[ H and H.group(1) or '#' + str( len(identities) ) ] = chunk
+		return objects
+	
+	def resolves(self, handler, base, versions):
+		'''Whether the merge handler would combine the versions several sides made of
+		   one object (None for a deleted object) without a conflict.
+		   Like the merge, a deletion gives way to the other sides' edits.'''
+		texts = []
+		for name, text in versions:
+			if text is not None and not text in [ t for n, t in texts ]:
+				texts.append( (name, text) )
+		if len(texts) < 2:
+			return True
+		if base is None and handler.greedyAdds:
+			return True
+		
+		merger = handler()
+		name, merged = texts[0]
+		for other, text in texts[1:]:
+			merged = merger._lastDitchMerge( merged, text, name, other )
+			if not merged:
+				return False
+		return True
+	
+	def run(self):
+		'''Check every object type, returning a short summary'''
+		out = []
+		for objType in self.order:
+			handler = smw.merge.get( objType, smw.merge['unknown'] )
+			if not handler or ( selection and not objType in selection.types ):
+				continue
+			x = self.files[-1].get( objType, {} )
+			sides = [ f.get( objType, {} ) for f in self.files[:-1] ]
+			
+			changed = []
+			for side in sides:
+				changed.append( set( [ identity for identity in set(side).union(x) if side.get(identity) <> x.get(identity) ] ) )
+			
+			overlapping = 0
+			conflicts = 0
+			for identity in set().union(*changed):
+				touched = [ n for n in range( len(sides) ) if identity in changed[n] ]
+				#several sides making the same change is not an overlap
+				if len( set( [ sides[n].get(identity) for n in touched ] ) ) < 2:
+					continue
+				overlapping += 1
+				if not self.resolves( handler, x.get(identity), [ (self.names[n], sides[n].get(identity)) for n in touched ] ):
+					conflicts += 1
+					self.conflicts.append( (objType, identity, [ self.names[n] for n in touched ]) )
+			
+			counts = '  '.join( [ name + ': ' + str( len(c) ) + ' changed' for name, c in zip(self.names, changed) ] )
+			out.append( '%-6s %s  overlapping: %d  conflicts: %d' % (objType, counts, overlapping, conflicts) )
+		
+		for objType, identity, touched in self.conflicts:
+			out.append( 'conflict: ' + objType + ' ' + ( identity[:1] == '#' and identity or 'H=' + identity ) + ' changed by ' + ', '.join(touched) )
+		if self.conflicts:
+			out.append( str( len(self.conflicts) ) + ' conflict(s)' )
+		else:
+			out.append('clean')
+		return '\n'.join(out)
+
+
+########################################################
+##
+##   Revision store
+##
+########################################################
+
+class revisionStore:
+	'''Local history of SMW revisions stored as object level deltas (--store).
+	   Revisions are kept in the parsed form the merge works on, the diff strings of every
+	   object type (see inFile.compact), so a stored revision becomes a parsedFile without
+	   parsing any text.  A revision lists the content hashes of its objects, per type, as
+	   a delta against its parent revision and stores only the object strings its parent
+	   does not have.  Every snapshotEvery revisions the full lists are stored instead,
+	   which bounds the number of deltas applied to rebuild a revision.'''
+	snapshotEvery = 50
+	
+	def __init__(self, path):
+		self.path = path
+		if not os.path.isdir( os.path.join(path, 'revisions') ):
+			os.makedirs( os.path.join(path, 'revisions') )
+		#rebuilt manifests, by revision
+		self.manifests = {}
+	
+	def filename(self, revision):
+		return os.path.join( self.path, 'revisions', revision )
+	
+	def load(self, revision):
+		f = open( self.filename(revision), 'rb' )
+		record = marshal.loads( zlib.decompress( f.read() ) )
+		f.close()
+		return record
+	
+	def revisions(self):
+		return os.listdir( os.path.join(self.path, 'revisions') )
+	
+	def head(self):
+		'''The most recently added revision, None for an empty store'''
+		try:
+			f = open( os.path.join(self.path, 'HEAD'), 'rb' )
+			head = f.read().strip()
+			f.close()
+		except IOError:
+			return None
+		return head or None
+	
+	def resolve(self, prefix):
+		'''The revision starting with prefix'''
+		found = [ revision for revision in self.revisions() if revision.startswith(prefix) ]
+		if len(found) <> 1:
+			raise SMWError( 'No unique revision ' + prefix + ' in store ' + self.path )
+		return found[0]
+	
+	def manifest(self, revision):
+		'''The object type order, the content hashes of the objects of every type
+		   and the object strings by hash of a revision'''
+		if self.manifests.has_key(revision):
+			return self.manifests[revision]
+		
+		#walk back to the last full snapshot, then apply the deltas forward
+		chain = []
+		record = self.load(revision)
+		while True:
+			chain.append(record)
+			if record['base'] is None:
+				break
+			record = self.load( record['base'] )
+		
+		hashes = {}
+		strings = {}
+		for record in reversed(chain):
+			strings.update( record['strings'] )
+			if record['base'] is None:
+				hashes = dict( record['types'] )
+				continue
+			previous = hashes
+			hashes = {}
+			for objType, delta in record['types'].items():
+				hashes[objType] = self.applyDelta( previous.get(objType, []), delta )
+		
+		order = chain[0]['order']
+		strings = dict( [ (h, strings[h]) for objType in order for h in hashes.get(objType, []) ] )
+		self.manifests[revision] = (order, hashes, strings)
+		return self.manifests[revision]
+	
+	def delta(self, old, new):
+		'''Opcodes turning the hash list old into new: (start, end) copies a range of
+		   old, a list inserts those hashes'''
+		ops = []
+		for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+			if tag == 'equal':
+				ops.append( (i1, i2) )
+			elif j2 > j1:
+				ops.append( new[j1:j2] )
+		return ops
+	
+	def applyDelta(self, old, delta):
+		new = []
+		for op in delta:
+			if type(op) == tuple:
+				new.extend( old[ op[0]:op[1] ] )
+			else:
+				new.extend(op)
+		return new
+	
+	def add(self, compact, name='', parent=None):
+		'''Store a revision given in compact form (see inFile.compact) as a child of
+		   parent (the head by default) and return its id'''
+		order, typeStrings = compact
+		hashes = {}
+		strings = {}
+		for objType in order:
+			hashes[objType] = []
+			for string in typeStrings.get(objType, []):
+				h = hashlib.sha1(string).hexdigest()
+				hashes[objType].append(h)
+				strings[h] = string
+		revision = contentKey( [ objType + '\0' + '\0'.join( hashes[objType] ) for objType in order ] )
+		
+		if os.path.exists( self.filename(revision) ):
+			#stored before, keep its history
+			self.setHead(revision)
+			return revision
+		if parent is None:
+			parent = self.head()
+		
+		#parent is the previous revision, base the one the delta applies to (None for a snapshot)
+		record = {'parent': parent, 'base': None, 'depth': 0, 'order': order, 'name': name, 'time': time.time()}
+		if parent:
+			parentRecord = self.load(parent)
+			record['depth'] = parentRecord['depth'] + 1
+		if parent and record['depth'] % self.snapshotEvery:
+			parentOrder, parentHashes, parentStrings = self.manifest(parent)
+			record['base'] = parent
+			record['types'] = dict( [ (objType, self.delta( parentHashes.get(objType, []), hashes[objType] )) for objType in order ] )
+			record['strings'] = dict( [ (h, string) for h, string in strings.items() if not parentStrings.has_key(h) ] )
+		else:
+			record['types'] = hashes
+			record['strings'] = strings
+		
+		f = open( self.filename(revision), 'wb' )
+		f.write( zlib.compress( marshal.dumps(record) ) )
+		f.close()
+		self.setHead(revision)
+		return revision
+	
+	def setHead(self, revision):
+		f = open( os.path.join(self.path, 'HEAD'), 'wb' )
+		f.write(revision)
+		f.close()
+	
+	def rebuild(self, revision):
+		'''A stored revision as a parsedFile'''
+		order, hashes, strings = self.manifest(revision)
+		return parsedFile( (order, dict( [ (objType, [ strings[h] for h in hashes.get(objType, []) ]) for objType in order ] )) )
+	
+	def log(self):
+		'''A line per revision, newest first'''
+		out = []
+		records = [ (revision, self.load(revision)) for revision in self.revisions() ]
+		for revision, record in sorted( records, key=lambda item: item[1]['time'], reverse=True ):
+			out.append( '%s %s %-8s %s' % ( revision[:12], ( record['parent'] or '-' * 12 )[:12],
+											record['base'] and 'delta' or 'snapshot', record['name'] ) )
+		return '\n'.join(out)
+
+store = None
+
+
+########################################################
+##
+##   History replay
+##
+########################################################
+
+class historyReplay:
+	'''Benchmark the merger on the merges recorded in a git repository (--replay-git).
+	   Every .smw file that a merge commit took from more than one changed parent is
+	   merged again from the parents and their merge base, timed phase by phase and
+	   compared with the committed result.'''
+	def __init__(self, repo, limit=0):
+		self.repo = repo
+		self.limit = limit
+		#one dict per replayed file
+		self.records = []
+		#frozen bases by content, many merges in a history start from the same version of a file
+		self.bases = lruCache(8)
+	
+	def git(self, *args):
+		'''Output of a git command run in the repository'''
+		process = subprocess.Popen( ['git', '-C', self.repo] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+		out, err = process.communicate()
+		if process.returncode:
+			raise IOError( 'git ' + ' '.join(args) + ': ' + err.strip() )
+		return out
+	
+	def merges(self):
+		'''(commit, parents) of every merge commit, newest first'''
+		merges = []
+		for line in self.git( 'log', '--merges', '--format=%H %P' ).splitlines():
+			commits = line.split()
+			merges.append( (commits[0], commits[1:]) )
+		return merges
+	
+	def changed(self, base, commit):
+		'''The .smw files that differ between two commits'''
+		return set( [ path for path in self.git( 'diff', '--name-only', base, commit ).splitlines() if path.lower().endswith('.smw') ] )
+	
+	def replay(self, commit, parents, base, path):
+		'''Merge one file of a merge commit again and return its record'''
+		record = {'commit': commit, 'parents': parents, 'base': base, 'path': path}
+		try:
+			texts = [ self.git( 'show', rev + ':' + path ) for rev in parents + [base] ]
+			committed = self.git( 'show', commit + ':' + path )
+		except IOError:
+			#added or removed by one of the sides, nothing to merge
+			record['outcome'] = 'skipped'
+			return record
+		
+		global masterObjOrder
+		masterObjOrder = Order()
+		first = len(profile.events)
+		started = time.time()
+		try:
+			with profile.phase('parse'):
+				sides = [ inFile(text) for text in texts[:-1] ]
+				key = contentKey( texts[-1:] )
+				x = self.bases.get(key)
+				if x is None:
+					x = inFile( texts[-1] ).freeze()
+					self.bases.put(key, x)
+				else:
+					masterObjOrder.integrate(x.objOrder)
+			record['objects'] = sum( [ len(f) for f in sides + [x] ] )
+			text = merge(sides, x)
+			if text.rstrip(newline) == committed.rstrip(newline):
+				record['outcome'] = 'same'
+			else:
+				record['outcome'] = 'differs'
+		except Exception, err:
+			record['outcome'] = 'error: ' + str(err)
+		record['seconds'] = time.time() - started
+		
+		#phase totals, merges of the separate object types and parses of the separate files summed up
+		phases = {}
+		#(only the complete 'X' events have a duration, --memory-profile adds 'C' counter events)
+		for event in profile.events[first:]:
+			if event['ph'] <> 'X':
+				continue
+			name = event['name'].split(' ')[0]
+			phases[name] = phases.get(name, 0) + event['dur'] / 1000000.0
+		record['phases'] = phases
+		return record
+	
+	def run(self):
+		'''Replay the merges, printing a line per file and a summary'''
+		replayed = 0
+		for commit, parents in self.merges():
+			if self.limit and replayed >= self.limit:
+				break
+			try:
+				base = self.git( 'merge-base', '--octopus', *parents ).strip()
+			except IOError:
+				logging.info( 'replay: ' + commit + ' has no merge base, skipped' )
+				continue
+			
+			#only files changed by more than one parent need a merge
+			changes = [ self.changed(base, parent) for parent in parents ]
+			paths = sorted( [ path for path in set().union(*changes) if len( [ c for c in changes if path in c ] ) > 1 ] )
+			if not paths:
+				continue
+			replayed += 1
+			for path in paths:
+				record = self.replay(commit, parents, base, path)
+				self.records.append(record)
+				print '%-10s %-40s %7s %9s  %s' % ( commit[:10], path, record.get('objects', ''),
+												   'seconds' in record and '%.3f' % record['seconds'] or '', record['outcome'] )
+		print self.summary()
+	
+	def summary(self):
+		timed = [ record for record in self.records if 'seconds' in record ]
+		seconds = sum( [ record['seconds'] for record in timed ] )
+		objects = sum( [ record.get('objects', 0) for record in timed ] )
+		out = [ '%d file(s) replayed, %d same as committed, %d different, %d error(s), %d skipped' % (
+					len(timed), len( [ r for r in timed if r['outcome'] == 'same' ] ), len( [ r for r in timed if r['outcome'] == 'differs' ] ),
+					len( [ r for r in timed if r['outcome'].startswith('error') ] ), len(self.records) - len(timed) ) ]
+		if seconds:
+			out.append( '%.3f seconds, %.0f objects per second' % (seconds, objects / seconds) )
+		phases = {}
+		for record in timed:
+			for name, phaseSeconds in record['phases'].items():
+				phases[name] = phases.get(name, 0) + phaseSeconds
+		for name, phaseSeconds in sorted( phases.items(), key=lambda item: item[1], reverse=True ):
+			out.append( '  %-24s %9.3f' % (name, phaseSeconds) )
+		return '\n'.join(out)
+	
+	def errors(self):
+		return [ record for record in self.records if record['outcome'].startswith('error') ]
+	
+	def writeReport(self, filename):
+		'''Write the records as JSON, a corpus to compare later runs against'''
+		f = open(filename, 'wb')
+		json.dump( self.records, f, indent=1, sort_keys=True )
+		f.close()
+
+
 ########################################################
 ##
 ##   File operations
@@ -1046,7 +3067,7 @@ class outFile( inFile ):
 ########################################################
 def read_file(filename):
     try:
-        f = open(filename, 'rb')
+        f = open_file(filename)
         l = f.readlines()
         f.close()
     except IOError, err:
@@ -1055,48 +3076,230 @@ def read_file(filename):
     else:
         return l
 
+def archive_member(filename):
+	'''Split an "archive.zip:member" name into the archive and member names (None if not one)'''
+	archive, sep, member = filename.partition('.zip:')
+	if sep and member:
+		return archive + '.zip', member
+	return None
+
+def open_file(filename):
+	'''Open an input file for reading: plain, gzip compressed (.gz) or a member of
+	   a zip archive (archive.zip:member).  Compressed data is decompressed as it is read.'''
+	inArchive = archive_member(filename)
+	if inArchive:
+		try:
+			archive = zipfile.ZipFile( inArchive[0] )
+		except zipfile.BadZipfile, err:
+			raise IOError( str(err) )
+		#the member reads through its own handle on the archive file
+		try:
+			return archive.open( inArchive[1] )
+		except (KeyError, zipfile.BadZipfile), err:
+			raise IOError( str(err) )
+		finally:
+			archive.close()
+	if filename.endswith('.gz'):
+		return gzip.open(filename, 'rb')
+	return open(filename, 'rb')
+
+def read_objects(filename, blockSize=65536):
+	'''Read a file block by block and yield the object chunks inFile.readData takes,
+	   so that parsing starts before the whole (decompressed) file is in memory'''
+	try:
+		f = open_file(filename)
+	except IOError, err:
+		print "can't open file '" + filename + "'. aborting."
+		sys.exit(-1)
+	separator = newline + ']' + newline
+	pending = ''
+	while True:
+		block = f.read(blockSize)
+		if not block:
+			break
+		chunks = ( pending + block ).split(separator)
+		pending = chunks.pop()
+		for chunk in chunks:
+			yield chunk
+	f.close()
+	yield pending
+
+def write_file(filename, text, blockSize=65536):
+	'''Write text to a plain file, a gzip compressed one (.gz) or a member of a zip
+	   archive (archive.zip:member, the archive's other members are kept), in blocks'''
+	inArchive = archive_member(filename)
+	if inArchive:
+		archive, member = inArchive
+		kept = []
+		if os.path.exists(archive):
+			z = zipfile.ZipFile(archive, 'r')
+			kept = [ (info, z.read(info.filename)) for info in z.infolist() if info.filename <> member ]
+			z.close()
+		#the new archive is written next to the old one and only replaces it once complete
+		temp = archive + '.' + str(os.getpid())
+		try:
+			z = zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED)
+			for info, data in kept:
+				z.writestr(info, data)
+			z.writestr(member, text)
+			z.close()
+			if os.path.exists(archive):
+				os.remove(archive)
+			os.rename(temp, archive)
+		finally:
+			if os.path.exists(temp):
+				os.remove(temp)
+		return
+	
+	if filename.endswith('.gz'):
+		f = gzip.open(filename, 'wb')
+	else:
+		f = open(filename, 'wb')
+	for start in range( 0, len(text), blockSize ):
+		f.write( text[start:start + blockSize] )
+	f.close()
+
 		
-def merge():
-	global ai, bi, xi
+def _parseWorker(job):
+	'''Read (unless given the text) and parse one file in a worker process'''
+	filename, text = job
+	if text is None:
+		try:
+			open_file(filename).close()
+		except IOError:
+			return None
+		text = read_objects(filename)
+	return inFile(text).compact()
+
+def parseFiles(filenames, texts):
+	'''Parse the files concurrently, one process each.  The object type
+	   order is integrated afterwards, in the same order as a sequential parse.'''
+	import multiprocessing
+	pool = multiprocessing.Pool( len(filenames) )
+	try:
+		results = pool.map( _parseWorker, zip(filenames, texts) )
+	finally:
+		pool.close()
+	
+	files = []
+	for filename, compact in zip(filenames, results):
+		if compact is None:
+			print "can't open file '" + filename + "'. aborting."
+			sys.exit(-1)
+		parsed = parsedFile(compact)
+		masterObjOrder.integrate(parsed.objOrder)
+		files.append(parsed)
+	return files
+
+def merge(sides, base):
+	'''Merge the parsed side files against the parsed base file.
+	   Two sides use the classic three-way merge, more than two an n-way merge.'''
 	global result, oresult, conflict
 	
 	result = []
 	oresult = {}
 	conflict = False
 	objResult = []
-        mergeHandler = smw.merge['unknown']
+	mergeHandler = smw.merge['unknown']
+	names = sideNames( len(sides) )
 	
 	for objType in masterObjOrder:
+		if selection and not objType in selection.types:
+			continue
 		try:
-                        mergeHandler = smw.merge[objType]
-                except:
-                        mergeHandler = smw.merge['unknown']
-                        logging.info( 'Unhandled merge object: '+objType+'.  Using Conservative SMW merge.')
-
-		if mergeHandler:
-                        objResult = mergeHandler( ai.diffOut(objType), bi.diffOut(objType), xi.diffOut(objType) )
-                	oresult[objType] = objResult
-                        logging.info( objType + ' - conflict: ' + str(conflict) ) 
-                	if objResult.conflict:
-                        	conflict = True
+			mergeHandler = smw.merge[objType]
+		except:
+			mergeHandler = smw.merge['unknown']
+			logging.info( 'Unhandled merge object: '+objType+'.  Using Conservative SMW merge.')
 		
-                        result.extend(objResult)
+		if mergeHandler:
+			profile.objType = objType
+			with profile.phase('merge ' + objType):
+				expansions = {}
+				if objType == smw.type.symbol and options.folder_tree:
+					lists, expansions = collapseFolders( [ folderTree( f.objList.get(objType, []), f.diffOut(objType) ) for f in sides + [base] ] )
+					logging.info( objType + ' - ' + str(len(expansions)) + ' unchanged folder(s) skipped' )
+				else:
+					lists = [ side.diffOut(objType) for side in sides ] + [ base.diffOut(objType) ]
+				objResult = mergeType( mergeHandler, objType, lists, names )
+				if expansions:
+					objResult.result = expandFolders( objResult.result, expansions )
+			oresult[objType] = objResult
+			if profile.memory:
+				for n, f in enumerate( sides + [base] ):
+					profile.retained( 'input ' + ( names + ['base'] )[n], objType, f.__dict__.get('objList', {}).get(objType) )
+				profile.retained( 'side diffs (xa/xb)', objType, [ getattr(objResult, 'xa', None), getattr(objResult, 'xb', None) ] )
+				profile.retained( 'merge result (oresult)', objType, objResult.result )
+			if objResult.differ.fallbacks:
+				logging.warn( objType + ' - diff budget exhausted, ' + str(objResult.differ.fallbacks) + ' block(s) merged without intraline matching' )
+			logging.info( objType + ' - conflict: ' + str(conflict) ) 
+			if objResult.conflict:
+				conflict = True
+			
+			result.extend(objResult)
 		
 	logging.info('conflict = ' + str(conflict))
 	
 	global o
-	o = outFile(result)
-	
+	baseRefs = {}
+	if outFile.renumber == 'dense':
+		for objType in masterObjOrder:
+			baseRefs[objType] = {}
+			for element in base.diffOut(objType):
+				found = mergeCheck.refFinder.search(element)
+				if found:
+					baseRefs[objType][ found.group(1) ] = element
+	with profile.phase('outFile'):
+		o = outFile(result, names, baseRefs)
+	if profile.memory:
+		for name, table in o.__dict__.items():
+			profile.retained( 'outFile ' + name, '', table )
+	if state:
+		state.refs = o.chosenRefs
+		state.save()
+	with profile.phase('render'):
+		if selection:
+			text = selection.render(o)
+		else:
+			text = str(o)
+	profile.retained( 'rendered text', '', text )
+	return text
+
+def writeResult(text):
+	'''Write the merged text, verifying it and writing the profile if requested'''
 	if options.output_file:
-		f = open(sys.argv[4], 'wb')
-		f.write(str(o))
-		f.write(newline)
-		f.close()
+		write_file( options.output_file, text + newline )
 	else:
-		print str(o)
+		print text
+	
+	if options.verify:
+		with profile.phase('verify'):
+			problems = verify(text, options.output_file or 'merge result')
+	else:
+		problems = 0
+	
+	writeProfile()
+	if problems:
+		sys.exit(1)
+
+def writeProfile():
+	'''Write the profiling report and trace if they were requested'''
+	if options.profile:
+		f = open(options.profile, 'wb')
+		f.write( profile.report(options.profile_top) )
+		f.close()
+	if options.trace:
+		profile.writeTrace(options.trace)
+	if options.memory_profile:
+		f = open(options.memory_profile, 'wb')
+		f.write( profile.memoryReport() )
+		f.close()
 
 def main():	
-	parser = OptionParser(usage="usage: %prog [options] your-file their-file original-file",
+	parser = OptionParser(usage="usage: %prog [options] your-file their-file [more-files ...] original-file\n"
+								"       %prog --verify smw-file\n"
+								"       %prog --where-used SIGNAL smw-file\n"
+								"       %prog --replay-git REPO",
 							version="%prog " + version, 
 							description=program_description,
 							epilog=copyright)
@@ -1106,6 +3309,60 @@ def main():
 						help='Logging level.  '  'LEVEL can be "' + '", "'.join(LOGGING_LEVELS.keys()) + '"')
 	parser.add_option("-f", "--log-file", dest="log_file",
 						help="write debugging information to FILE", metavar="FILE")
+	parser.add_option("--verify", dest="verify", action="store_true", default=False,
+						help="check the cross references of the result (or of a single given file); exits with 1 on any problem")
+	parser.add_option("--where-used", dest="where_used", metavar="SIGNAL", action="append",
+						help="list the symbols and inputs/outputs using SIGNAL in a single given file (may be repeated)")
+	parser.add_option("--check", dest="check", action="store_true", default=False,
+						help="only tell whether the merge would be clean: print a summary per object type and exit with 0 if clean, 2 on conflicts (1 means the check itself failed)")
+	parser.add_option("--types", dest="types", metavar="TYPES",
+						help="merge only the comma separated object types (e.g. Sm,Sg), copying every other type unparsed from the --passthrough file")
+	parser.add_option("--passthrough", dest="passthrough", metavar="FILE", choices=['yours', 'theirs', 'base'], default='yours',
+						help="file the types left out by --types come from: yours, theirs or base (default %default)")
+	parser.add_option("--diff-budget", dest="diff_budget", metavar="N", type="int", default=0,
+						help="intraline comparisons allowed per object type before falling back to a plain diff (default unlimited)")
+	parser.add_option("--diff-time-budget", dest="diff_time_budget", metavar="SECONDS", type="float", default=0,
+						help="seconds of intraline matching allowed per object type, checked on every line compared, before falling back to a plain diff (default unlimited)")
+	parser.add_option("--renumber", dest="renumber", metavar="MODE", choices=['bump', 'dense'], default='bump',
+						help="how colliding H values are resolved: bump increments them (default), dense keeps the H value of every base object (several objects carrying a base H value: the one closest to that base object keeps it) and numbers the other objects compactly after them, by side")
+	parser.add_option("--detect-moves", dest="detect_moves", action="store_true", default=False,
+						help="recognize relocated blocks of objects as moves instead of conflicting deletes and adds")
+	parser.add_option("--parallel-parse", dest="parallel_parse", action="store_true", default=False,
+						help="read and parse the input files concurrently, one process each")
+	parser.add_option("--folder-tree", dest="folder_tree", action="store_true", default=False,
+						help="skip symbol folders that are identical in every file (compared by Merkle hash of the folder tree)")
+	parser.add_option("-j", "--jobs", dest="jobs", metavar="N", type="int", default=1,
+						help="diff large object types in N parallel segments (default %default)")
+	parser.add_option("--split-threshold", dest="split_threshold", metavar="N", type="int", default=anchorSplit.threshold,
+						help="smallest object type, in objects, that --jobs splits (default %default)")
+	parser.add_option("--index-cache", dest="index_cache", metavar="N", type="int", default=baseIndex.cache.maxSize,
+						help="number of base objects whose diff indexes are kept for reuse (default %default)")
+	parser.add_option("--cache-dir", dest="cache_dir", metavar="DIR",
+						help="keep merge results in DIR so repeated merges of the same inputs become lookups")
+	parser.add_option("--cache-size", dest="cache_size", metavar="MB", type="int", default=256,
+						help="size limit of the merge cache in megabytes (default %default)")
+	parser.add_option("--state", dest="state", metavar="FILE",
+						help="load and save the merge alignment in FILE (keep it next to the output) so a later merge of similar inputs only re-diffs what changed")
+	parser.add_option("--store", dest="store", metavar="DIR",
+						help="keep a history of revisions in DIR as object level deltas; inputs given as @REVISION are taken from it without parsing")
+	parser.add_option("--store-add", dest="store_add", metavar="FILE", action="append",
+						help="add FILE to the --store as a new revision (may be repeated) and print its id")
+	parser.add_option("--store-log", dest="store_log", action="store_true", default=False,
+						help="list the revisions in the --store")
+	parser.add_option("--replay-git", dest="replay_git", metavar="REPO",
+						help="benchmark: merge the .smw files of every merge commit in the git repository REPO again and compare with the committed result")
+	parser.add_option("--replay-limit", dest="replay_limit", metavar="N", type="int", default=0,
+						help="replay only the N most recent merges (default all)")
+	parser.add_option("--replay-report", dest="replay_report", metavar="FILE",
+						help="write the timing, phases and outcome of every replayed file to FILE as JSON")
+	parser.add_option("--profile", dest="profile", metavar="FILE",
+						help="write the most expensive objects (parse, diff and merge time) to FILE")
+	parser.add_option("--profile-top", dest="profile_top", metavar="N", type="int", default=20,
+						help="number of objects listed by --profile (default 20)")
+	parser.add_option("--trace", dest="trace", metavar="FILE",
+						help="write a chrome://tracing timeline of the merge phases to FILE")
+	parser.add_option("--memory-profile", dest="memory_profile", metavar="FILE",
+						help="write the peak and retained memory of every merge phase and object type to FILE (also adds memory counters to --trace)")
 	
 	global options
 	(options, args) = parser.parse_args()
@@ -1115,17 +3372,132 @@ def main():
 						  format='%(asctime)s %(levelname)s: %(message)s',
 						  datefmt='%Y-%m-%d %H:%M:%S')
 	
-	if len(args) > 2:
+	profile.enabled = bool( options.profile or options.trace or options.memory_profile )
+	profile.memory = bool( options.memory_profile )
+	baseIndex.cache.maxSize = options.index_cache
+	smwDiffer.maxComparisons = options.diff_budget
+	smwDiffer.maxSeconds = options.diff_time_budget
+	smwDiffer.detectMoves = options.detect_moves
+	outFile.renumber = options.renumber
+	anchorSplit.jobs = options.jobs
+	anchorSplit.threshold = options.split_threshold
+	
+	global state
+	if options.state:
+		state = mergeState( options.state )
+	
+	global cache
+	if options.cache_dir:
+		cache = mergeCache( options.cache_dir, options.cache_size * 1024 * 1024 )
+	
+	global store
+	if options.store:
+		store = revisionStore( options.store )
+	#inputs taken from the store
+	revisions = {}
+	for n in range( len(args) ):
+		if store and args[n].startswith('@'):
+			try:
+				revisions[n] = store.resolve( args[n][1:] )
+			except SMWError, err:
+				parser.error( str(err) )
+	if revisions and ( options.types or options.check ):
+		parser.error("--types and --check need the text of every input, not a stored revision")
+	
+	global selection
+	if options.types:
+		passthrough = { 'yours': 0, 'theirs': len(args) - 2, 'base': len(args) - 1 }[ options.passthrough ]
+		selection = typeSelection( [ objType.strip() for objType in options.types.split(',') ], ( sideNames( len(args) - 1 ) + [''] )[passthrough] )
+		outFile.merged = selection.types
+	
+	if store and ( options.store_add or options.store_log ):
+		for filename in options.store_add or []:
+			print store.add( inFile( read_objects(filename) ).compact(), filename )
+		if options.store_log:
+			print store.log()
+	elif options.replay_git:
+		if selection:
+			parser.error("--types cannot be used with --replay-git")
+		profile.enabled = True
+		replay = historyReplay( options.replay_git, options.replay_limit )
+		try:
+			replay.run()
+		except IOError, err:
+			print err
+			sys.exit(-1)
+		if options.replay_report:
+			replay.writeReport(options.replay_report)
+		writeProfile()
+		if replay.errors():
+			sys.exit(1)
+	elif len(args) > 2:
+		# more than two side files before the original file perform an n-way (octopus) merge
+		#the files are streamed into the parser unless the cache, the type selection or the check need the text first
+		texts = [ None ] * len(args)
+		if cache or selection or options.check:
+			texts = [ not revisions.has_key(n) and "".join(read_file( args[n] )) or None for n in range( len(args) ) ]
 		global af, bf, xf
-		af = "".join(read_file(sys.argv[1]))
-		bf = "".join(read_file(sys.argv[2]))
-		xf = "".join(read_file(sys.argv[3]))
-		global ai, bi, xi
-		ai = inFile(af)
-		bi = inFile(bf)
-		xi = inFile(xf)
-		
-		merge()
+		af, bf, xf = texts[0], texts[1], texts[-1]
+		
+		if options.check:
+			with profile.phase('check'):
+				check = mergeCheck( texts, sideNames( len(args) - 1 ) )
+				print check.run()
+			writeProfile()
+			sys.exit( check.conflicts and 2 or 0 )
+		
+		text = None
+		key = None
+		#a merge with --state depends on the saved H values and has to save the state again, so it always runs
+		if cache and not state:
+			settings = 'renumber ' + outFile.renumber + ', moves ' + str(smwDiffer.detectMoves)
+			if selection:
+				key = cache.key( 'file', settings, ','.join( sorted(selection.types) ), selection.side, *texts )
+			else:
+				key = cache.key( 'file', settings, *[ texts[n] or 'revision ' + revisions[n] for n in range( len(args) ) ] )
+			text = cache.get('file', key)
+		
+		if text is None and selection:
+			#only the selected types are parsed, the passthrough file's other objects are kept raw
+			for n in range( len(args) ):
+				order, texts[n], others = selection.split( texts[n] )
+				masterObjOrder.integrate(order)
+				if n == passthrough:
+					selection.raw = others
+		
+		if text is None:
+			global ai, bi, xi
+			if options.parallel_parse and not revisions:
+				with profile.phase('parse'):
+					sides = parseFiles(args, texts)
+				xi = sides.pop()
+			else:
+				files = []
+				for n in range( len(args) ):
+					with profile.phase('parse ' + args[n]):
+						if revisions.has_key(n):
+							files.append( store.rebuild( revisions[n] ) )
+							masterObjOrder.integrate( files[-1].objOrder )
+						else:
+							files.append( inFile( texts[n] or read_objects(args[n]) ) )
+				sides, xi = files[:-1], files[-1]
+			ai, bi = sides[0], sides[1]
+			#every side is merged against the same base, share it read-only
+			xi = xi.freeze()
+			
+			text = merge(sides, xi)
+			if key and not [ r for r in oresult.values() if r.differ.fallbacks or r.lossy ]:
+				cache.put('file', key, text)
+		
+		writeResult(text)
+	elif len(args) == 1 and options.where_used:
+		usage = inFile( "".join(read_file(args[0])) ).signalUsage
+		for name in options.where_used:
+			for symbol, slot in usage.whereUsed(name):
+				print '\t'.join( [name, symbol.H, slot, symbol.name] )
+	elif len(args) == 1 and options.verify:
+		if verify( "".join(read_file(args[0])), args[0] ):
+			sys.exit(1)
 	else:
 		parser.print_help()
 
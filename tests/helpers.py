@@ -0,0 +1,65 @@
+'''Shared fixtures for the smwmerge tests: small SMW objects and files, merges run in memory and runs of the command line'''
+import os
+import subprocess
+import sys
+from optparse import Values
+
+root = os.path.join( os.path.dirname( os.path.abspath(__file__) ), '..' )
+sys.path.insert( 0, root )
+import smwmerge
+
+
+def symbol(H, name=None, *keys):
+	'''A symbol object string, named symH unless given a name, with any extra key=value lines'''
+	return smwmerge.newline.join( ['[', 'ObjTp=Sm', 'H=' + str(H), 'Nm=' + ( name or 'sym' + str(H) )] + list(keys) + [']'] )
+
+def signal(H, name):
+	return smwmerge.newline.join( ['[', 'ObjTp=Sg', 'H=' + str(H), 'Nm=' + name, ']'] )
+
+def smwText(objects):
+	'''The text of an SMW file holding the given object strings'''
+	return smwmerge.newline.join(objects) + smwmerge.newline
+
+def names(result):
+	'''The names of the symbols in a merge result'''
+	return [ smwmerge.smwObject(element).name for element in result ]
+
+def resetGlobals(**options):
+	'''Put the module globals main() sets up back to a plain run with the given options'''
+	values = {'folder_tree': False}
+	values.update(options)
+	smwmerge.options = Values(values)
+	smwmerge.masterObjOrder = smwmerge.Order()
+	smwmerge.selection = None
+	smwmerge.cache = None
+	smwmerge.state = None
+	smwmerge.store = None
+
+def mergeTexts(texts):
+	'''Merge the side texts against the base text (last) like main() does, returning the output text'''
+	resetGlobals()
+	files = [ smwmerge.inFile(text) for text in texts ]
+	return smwmerge.merge( files[:-1], files[-1].freeze() )
+
+def symbolNames(text):
+	'''The names of the symbols in an SMW file's text, in file order'''
+	return [ obj.name for obj in smwmerge.inFile(text).objList.get('Sm', []) ]
+
+def writeFiles(directory, files):
+	for name, text in files.items():
+		f = open( os.path.join(directory, name), 'wb' )
+		f.write(text)
+		f.close()
+
+def readFile(directory, name):
+	f = open( os.path.join(directory, name), 'rb' )
+	text = f.read()
+	f.close()
+	return text
+
+def run(directory, *args):
+	'''Run smwmerge.py with the given arguments in directory, returning the exit code and the output'''
+	process = subprocess.Popen( [ sys.executable, os.path.join(root, 'smwmerge.py') ] + list(args), cwd=directory,
+								stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+	out, err = process.communicate()
+	return process.returncode, out
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from helpers import smwmerge, symbol
+
+
+class LossyResolutionNotReplayed(unittest.TestCase):
+	'''MergeSymbols gives up on symbols removed by both sides; that must not be cached'''
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		smwmerge.cache = smwmerge.mergeCache( self.path, 1024 * 1024 )
+		self.errors = []
+		self.showerror = smwmerge.tkMessageBox.showerror
+		smwmerge.tkMessageBox.showerror = lambda title, message: self.errors.append(title)
+
+	def tearDown(self):
+		smwmerge.tkMessageBox.showerror = self.showerror
+		smwmerge.cache = None
+		shutil.rmtree(self.path)
+
+	def resolve(self):
+		merge = smwmerge.MergeSymbols()
+		remove = smwmerge.Merge.marker.remove
+		result = merge._resolveConflict( [ symbol(1, 'symA') ], [ symbol(1, 'symB') ], (remove, remove) )
+		return merge, result
+
+	def testWarnsEveryTime(self):
+		for run in range(2):
+			merge, result = self.resolve()
+			self.assertTrue( merge.lossy )
+			self.assertEqual( result, (True, []) )
+		self.assertEqual( len(self.errors), 2 )
+		self.assertEqual( os.listdir(self.path), [] )
+
+	def testResolvedIsReplayed(self):
+		merge = smwmerge.MergeSymbols()
+		same = smwmerge.Merge.marker.same
+		first = merge._resolveConflict( [ symbol(1) ], [ symbol(2) ], (same, same) )
+		self.assertEqual( len( os.listdir(self.path) ), 1 )
+		self.assertEqual( merge._resolveConflict( [ symbol(1) ], [ symbol(2) ], (same, same) ), first )
+		self.assertFalse( merge.lossy )
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,53 @@
+import shutil
+import tempfile
+import unittest
+
+from helpers import symbol, signal, smwText, writeFiles, readFile, run, symbolNames
+
+
+class MergeCheck(unittest.TestCase):
+	'''--check tells whether the merge would be clean, and agrees with the merge'''
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		x = [ signal(4, 'sig_4') ] + [ symbol(H) for H in range(1, 6) ]
+		writeFiles( self.directory, {
+			'x.smw': smwText(x),
+			'renamed.smw': smwText( x[:2] + [ symbol(2, 'a2') ] + x[3:] ),
+			'clashing.smw': smwText( x[:2] + [ symbol(2, 'b2') ] + x[3:] ),
+			'other.smw': smwText( x[:4] + [ symbol(4, 'sym4', 'I1=4') ] + x[5:] ),
+			'deleted.smw': smwText( x[:2] + x[3:] ) } )
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def check(self, a, b):
+		return run( self.directory, '--check', a, b, 'x.smw' )
+
+	def merge(self, a, b):
+		rc, out = run( self.directory, a, b, 'x.smw', '-o', 'o.smw' )
+		return rc, symbolNames( readFile(self.directory, 'o.smw') )
+
+	def testClean(self):
+		rc, out = self.check( 'renamed.smw', 'other.smw' )
+		self.assertEqual( rc, 0 )
+		self.assertTrue( 'overlapping: 0  conflicts: 0' in out )
+		self.assertEqual( out.splitlines()[-1], 'clean' )
+		self.assertEqual( self.merge( 'renamed.smw', 'other.smw' )[0], 0 )
+
+	def testConflict(self):
+		rc, out = self.check( 'renamed.smw', 'clashing.smw' )
+		self.assertEqual( rc, 2 )
+		self.assertTrue( 'conflict: Sm H=2 changed by A, B' in out.splitlines() )
+		self.assertNotEqual( run( self.directory, 'renamed.smw', 'clashing.smw', 'x.smw', '-o', 'o.smw' )[0], 0 )
+
+	def testDeleteAndEdit(self):
+		#the merge keeps the edit of an object the other side deleted
+		for a, b in [ ('deleted.smw', 'renamed.smw'), ('renamed.smw', 'deleted.smw') ]:
+			rc, out = self.check(a, b)
+			self.assertEqual( rc, 0 )
+			self.assertTrue( 'overlapping: 1  conflicts: 0' in out )
+			self.assertEqual( self.merge(a, b), (0, ['sym1', 'a2', 'sym3', 'sym4', 'sym5']) )
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,74 @@
+import difflib
+import random
+import unittest
+
+from helpers import smwmerge
+
+
+def edited(random, x, alphabet):
+	'''A copy of x with a few random removals, additions and replacements'''
+	side = list(x)
+	for n in range( random.randint(0, 10) ):
+		pos = random.randint( 0, len(side) )
+		action = random.choice( ['remove', 'add', 'replace'] )
+		if action <> 'add' and pos < len(side):
+			del side[pos]
+		if action <> 'remove':
+			side[pos:pos] = [ random.choice(alphabet) for k in range( random.randint(1, 4) ) ]
+	return side
+
+
+class BaseMatcher(unittest.TestCase):
+	'''The shared index finds exactly the blocks difflib.SequenceMatcher does'''
+	def setUp(self):
+		self.random = random.Random(29)
+
+	def check(self, size, alphabet):
+		for run in range(50):
+			x = [ self.random.choice(alphabet) for n in range(size) ]
+			side = edited( self.random, x, alphabet )
+			self.assertEqual( smwmerge.baseIndex(x).opcodes(side), difflib.SequenceMatcher(None, x, side).get_opcodes() )
+
+	def testSmall(self):
+		#few distinct elements, so plenty of repeats and ties
+		self.check( 30, [ 'line' + str(n) + '\n' for n in range(8) ] )
+
+	def testAutojunk(self):
+		#sides of 200 elements or more drop their popular elements from matching
+		alphabet = [ 'line' + str(n) + '\n' for n in range(150) ] + [ 'popular\n' ] * 50
+		self.check( 300, alphabet )
+
+	def testDifferOutput(self):
+		alphabet = [ 'line' + str(n) + '\n' for n in range(40) ]
+		for run in range(20):
+			x = [ self.random.choice(alphabet) for n in range(100) ]
+			side = edited( self.random, x, alphabet )
+			self.assertEqual( list( smwmerge.smwDiffer().compareToBase(x, side) ), list( difflib.Differ().compare(x, side) ) )
+
+
+class AnchorSplit(unittest.TestCase):
+	'''Diffing in parallel segments gives the sequential output'''
+	def setUp(self):
+		self.random = random.Random(32)
+		self.jobs, self.threshold = smwmerge.anchorSplit.jobs, smwmerge.anchorSplit.threshold
+		smwmerge.anchorSplit.jobs, smwmerge.anchorSplit.threshold = 2, 10
+
+	def tearDown(self):
+		if smwmerge.anchorSplit.pool:
+			smwmerge.anchorSplit.pool.terminate()
+			smwmerge.anchorSplit.pool = None
+		smwmerge.anchorSplit.jobs, smwmerge.anchorSplit.threshold = self.jobs, self.threshold
+
+	def testSameAsSequential(self):
+		#mostly unique lines, so there are anchors to cut at
+		alphabet = [ 'line' + str(n) + '\n' for n in range(1000) ]
+		x = alphabet[:400]
+		sides = [ edited(self.random, x, alphabet) for n in range(3) ]
+		#one side moves a block, which is written plainly instead of intraline matched
+		sides.append( x[:50] + x[80:300] + x[50:80] + x[300:] )
+		self.assertTrue( smwmerge.anchorSplit.usable( x, smwmerge.smwDiffer() ) )
+		self.assertEqual( smwmerge.anchorSplit.compare(x, sides), [ list( smwmerge.smwDiffer().compareToBase(x, side) ) for side in sides ] )
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from helpers import smwmerge, symbol, names
+
+
+class MovedBlockEditedByOtherSide(unittest.TestCase):
+	'''A moves sym20..sym29 to the end while B deletes sym25 and renames sym26'''
+	def setUp(self):
+		smwmerge.smwDiffer.detectMoves = True
+		self.x = [ symbol(H) for H in range(60) ]
+		self.a = self.x[:20] + self.x[30:] + self.x[20:30]
+		self.b = self.x[:25] + [ symbol(26, 'sym26B') ] + self.x[27:]
+		self.expected = [ 'sym' + str(H) for H in range(20) + range(30, 60) + range(20, 25) ] + [ 'sym26B' ] + [ 'sym' + str(H) for H in range(27, 30) ]
+	
+	def tearDown(self):
+		smwmerge.smwDiffer.detectMoves = False
+	
+	def testThreeWay(self):
+		merge = smwmerge.MergeSymbols( self.a, self.b, self.x )
+		self.assertFalse( merge.conflict )
+		self.assertEqual( names(merge.result), self.expected )
+		#the edited symbol keeps B's reference
+		self.assertTrue( 'H-B=26' in merge.result[ self.expected.index('sym26B') ] )
+	
+	def testNWay(self):
+		merge = smwmerge.MergeSymbols( sides=[self.a, self.b, list(self.x)], x=self.x )
+		self.assertFalse( merge.conflict )
+		self.assertEqual( names(merge.result), self.expected )
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from helpers import smwmerge, symbol, names, smwText, mergeTexts, symbolNames
+
+
+class NWayMerge(unittest.TestCase):
+	'''Three sides merged against one base'''
+	def setUp(self):
+		self.x = [ symbol(H) for H in range(8) ]
+
+	def testSeparateChanges(self):
+		a = self.x[:1] + [ symbol(1, 'a1') ] + self.x[2:]
+		b = self.x[:3] + [ symbol(3, 'b3') ] + self.x[4:]
+		c = self.x[:5] + self.x[6:] + [ symbol(8, 'c8') ]
+		merge = smwmerge.MergeSymbols( sides=[a, b, c], x=self.x )
+		self.assertFalse( merge.conflict )
+		self.assertEqual( names(merge.result), ['sym0', 'a1', 'sym2', 'b3', 'sym4', 'sym6', 'sym7', 'c8'] )
+
+	def testSameAdditionOnce(self):
+		added = symbol(9, 'new')
+		sides = [ self.x + [added], self.x + [added], list(self.x) ]
+		merge = smwmerge.MergeSymbols( sides=sides, x=self.x )
+		self.assertFalse( merge.conflict )
+		self.assertEqual( names(merge.result).count('new'), 1 )
+
+	def testClashingAdditions(self):
+		x = ['one\n', 'two\n']
+		sides = [ ['one\n', 'a\n', 'two\n'], ['one\n', 'b\n', 'two\n'], ['one\n', 'two\n'] ]
+		merge = smwmerge.Merge( sides=sides, x=x )
+		self.assertTrue( merge.conflict )
+		self.assertEqual( merge.result, ['one\n', '<<<<<<< A\n', 'a\n', '=======\n', 'b\n', '>>>>>>> B\n', 'two\n'] )
+
+	def testAgreesWithThreeWay(self):
+		a = self.x[1:4] + [ symbol(4, 'a4') ] + self.x[5:]
+		b = self.x[:2] + self.x[3:6] + [ symbol(6, 'b6') ] + self.x[7:]
+		threeWay = smwmerge.MergeSymbols( a, b, self.x )
+		nWay = smwmerge.MergeSymbols( sides=[a, b], x=self.x )
+		self.assertEqual( (threeWay.conflict, names(threeWay.result)), (nWay.conflict, names(nWay.result)) )
+
+	def testFiles(self):
+		x = smwText(self.x)
+		a = smwText( self.x[:2] + [ symbol(2, 'a2') ] + self.x[3:] )
+		b = smwText( self.x[:4] + [ symbol(4, 'b4') ] + self.x[5:] )
+		c = smwText( self.x + [ symbol(8, 'c8') ] )
+		self.assertEqual( symbolNames( mergeTexts( [a, b, c, x] ) ),
+						  ['sym0', 'sym1', 'a2', 'sym3', 'b4', 'sym5', 'sym6', 'sym7', 'c8'] )
+
+
+if __name__ == '__main__':
+	unittest.main()
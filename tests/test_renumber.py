@@ -0,0 +1,28 @@
+import unittest
+
+from helpers import smwmerge, symbol, smwText, resetGlobals
+
+
+class DenseRenumbering(unittest.TestCase):
+	'''A deletes sym3 and adds a new symbol that also has H=3, B renames sym3'''
+	def setUp(self):
+		resetGlobals()
+		smwmerge.outFile.renumber = 'dense'
+		self.x = smwText( [ symbol(1), symbol(2), symbol(3) ] )
+		self.a = smwText( [ symbol(3, 'fresh'), symbol(1), symbol(2) ] )
+		self.b = smwText( [ symbol(1), symbol(2), symbol(3, 'sym3B') ] )
+
+	def tearDown(self):
+		smwmerge.outFile.renumber = 'bump'
+
+	def testBaseObjectKeepsItsH(self):
+		files = [ smwmerge.inFile(text) for text in (self.a, self.b, self.x) ]
+		result = smwmerge.inFile( smwmerge.merge( files[:2], files[2] ) )
+		H = dict( [ (obj.name, obj.H) for obj in result.objList['Sm'] ] )
+		self.assertEqual( H['sym3B'], '3' )
+		self.assertEqual( H['fresh'], '4' )
+		self.assertEqual( (H['sym1'], H['sym2']), ('1', '2') )
+
+
+if __name__ == '__main__':
+	unittest.main()
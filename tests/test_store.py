@@ -0,0 +1,84 @@
+import shutil
+import tempfile
+import unittest
+
+from helpers import smwmerge, symbol, signal, smwText, resetGlobals, writeFiles, readFile, run, symbolNames
+
+
+class RevisionStore(unittest.TestCase):
+	'''Revisions stored as deltas come back exactly as they went in'''
+	def setUp(self):
+		resetGlobals()
+		self.path = tempfile.mkdtemp()
+		self.snapshotEvery = smwmerge.revisionStore.snapshotEvery
+		smwmerge.revisionStore.snapshotEvery = 3
+		#each revision renames one symbol and adds one
+		objects = [ signal(4, 'sig_4') ] + [ symbol(H) for H in range(1, 6) ]
+		self.texts = []
+		for n in range(7):
+			objects = objects[:2 + n % 5] + [ symbol(2 + n % 5, 'rev' + str(n)) ] + objects[3 + n % 5:] + [ symbol(10 + n) ]
+			self.texts.append( smwText(objects) )
+
+	def tearDown(self):
+		smwmerge.revisionStore.snapshotEvery = self.snapshotEvery
+		shutil.rmtree(self.path)
+
+	def add(self, store):
+		return [ store.add( smwmerge.inFile(text).compact(), 'rev' + str(n) ) for n, text in enumerate(self.texts) ]
+
+	def testRoundTrip(self):
+		revisions = self.add( smwmerge.revisionStore(self.path) )
+		#a fresh store has to rebuild every revision from the files
+		store = smwmerge.revisionStore(self.path)
+		for revision, text in zip(revisions, self.texts):
+			original = smwmerge.inFile(text)
+			rebuilt = store.rebuild(revision)
+			for objType in original.objOrder:
+				self.assertEqual( rebuilt.diffOut(objType), original.diffOut(objType) )
+
+	def testDeltas(self):
+		store = smwmerge.revisionStore(self.path)
+		revisions = self.add(store)
+		records = [ store.load(revision) for revision in revisions ]
+		self.assertEqual( [ record['base'] is None for record in records ], [True, False, False, True, False, False, True] )
+		#a delta only holds the renamed and the added symbol
+		self.assertEqual( len( records[1]['strings'] ), 2 )
+		self.assertEqual( [ record['parent'] for record in records ], [None] + revisions[:-1] )
+		self.assertEqual( store.head(), revisions[-1] )
+
+	def testAddAgain(self):
+		store = smwmerge.revisionStore(self.path)
+		revisions = self.add(store)
+		self.assertEqual( store.add( smwmerge.inFile(self.texts[2]).compact() ), revisions[2] )
+		self.assertEqual( store.head(), revisions[2] )
+		self.assertEqual( len( store.revisions() ), len(revisions) )
+
+
+class StoredInputs(unittest.TestCase):
+	'''Merging @REV inputs from the store gives the same result as merging the files'''
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		base = [ signal(4, 'sig_4') ] + [ symbol(H) for H in range(1, 6) ]
+		writeFiles( self.directory, {
+			'x.smw': smwText(base),
+			'a.smw': smwText( base[:2] + [ symbol(2, 'a2') ] + base[3:] ),
+			'b.smw': smwText( base + [ symbol(6, 'b6') ] ) } )
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def testMergeRevisions(self):
+		rc, out = run( self.directory, '--store', 'store', '--store-add', 'x.smw', '--store-add', 'a.smw', '--store-add', 'b.smw' )
+		self.assertEqual( rc, 0 )
+		x, a, b = out.split()
+		rc, log = run( self.directory, '--store', 'store', '--store-log' )
+		self.assertEqual( sorted( line.split()[-1] for line in log.splitlines() ), ['a.smw', 'b.smw', 'x.smw'] )
+
+		self.assertEqual( run( self.directory, 'a.smw', 'b.smw', 'x.smw', '-o', 'files.smw' )[0], 0 )
+		self.assertEqual( run( self.directory, '--store', 'store', '@' + a[:8], '@' + b[:8], '@' + x[:8], '-o', 'stored.smw' )[0], 0 )
+		self.assertEqual( symbolNames( readFile(self.directory, 'files.smw') ), ['sym1', 'a2', 'sym3', 'sym4', 'sym5', 'b6'] )
+		self.assertEqual( readFile(self.directory, 'stored.smw'), readFile(self.directory, 'files.smw') )
+
+
+if __name__ == '__main__':
+	unittest.main()
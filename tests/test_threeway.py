@@ -0,0 +1,28 @@
+import unittest
+
+from helpers import smwmerge, symbol, names
+
+
+class OverlappingRemovals(unittest.TestCase):
+	'''A deletes sym0 and renames sym3 and sym7, B deletes sym4 and renames sym5.
+	   The side diffs cover different stretches of the base around sym3..sym5.'''
+	def setUp(self):
+		self.x = [ symbol(H) for H in range(10) ]
+		self.a = [ symbol(1), symbol(2), symbol(3, 'a3'), symbol(4), symbol(5), symbol(6), symbol(7, 'a7'), symbol(8), symbol(9) ]
+		self.b = [ symbol(0), symbol(1), symbol(2), symbol(3), symbol(5, 'b5'), symbol(6), symbol(7), symbol(8), symbol(9) ]
+		self.expected = ['sym1', 'sym2', 'a3', 'b5', 'sym6', 'a7', 'sym8', 'sym9']
+
+	def testMergers(self):
+		for merger in ( smwmerge.SMWMergeGreedy, smwmerge.SMWMergeConservative, smwmerge.MergeSymbols ):
+			merge = merger( self.a, self.b, self.x )
+			self.assertFalse( merge.conflict )
+			self.assertEqual( names(merge.result), self.expected, merger.__name__ )
+
+	def testSameAsNWay(self):
+		merge = smwmerge.MergeSymbols( sides=[self.a, self.b], x=self.x )
+		self.assertFalse( merge.conflict )
+		self.assertEqual( names(merge.result), self.expected )
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,50 @@
+import shutil
+import tempfile
+import unittest
+
+from helpers import smwmerge, symbol, signal, smwText, symbolNames, writeFiles, readFile, run
+
+
+def device(H, name, *keys):
+	return smwmerge.newline.join( ['[', 'ObjTp=Dv', 'H=' + str(H), 'Nm=' + name] + list(keys) + [']'] )
+
+
+class TypeSelection(unittest.TestCase):
+	'''--types Sm merges the symbols (and signals) only and copies the devices from one file.
+	   Both sides add a symbol with H=3, so one of them is renumbered.'''
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		base = [ device(1, 'Card', 'SmH=2'), signal(4, 'sig_4'), symbol(1, 'folder', 'mC=1', 'C1=2'), symbol(2, 'sym2', 'PrH=1', 'I1=4') ]
+		a = [ device(1, 'CardA', 'SmH=3') ] + base[1:] + [ symbol(3, 'a3') ]
+		b = [ device(1, 'CardB', 'SmH=3') ] + base[1:] + [ symbol(3, 'b3') ]
+		writeFiles( self.directory, {'a.smw': smwText(a), 'b.smw': smwText(b), 'x.smw': smwText(base)} )
+		self.devices = { 'yours': a[0], 'theirs': b[0], 'base': base[0] }
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def merge(self, passthrough):
+		rc, out = run( self.directory, '--types', 'Sm', '--passthrough', passthrough, 'a.smw', 'b.smw', 'x.smw', '-o', 'out.smw' )
+		self.assertEqual( rc, 0 )
+		return smwmerge.inFile( readFile(self.directory, 'out.smw') )
+
+	def testSymbolsMerged(self):
+		result = self.merge('theirs')
+		self.assertEqual( [ obj.name for obj in result.objList['Sm'] ], ['folder', 'sym2', 'a3', 'b3'] )
+		self.assertEqual( [ obj.name for obj in result.objList['Sg'] ], ['sig_4'] )
+
+	def testPassthroughFollowsRenumbering(self):
+		for passthrough, name in ( ('yours', 'a3'), ('theirs', 'b3') ):
+			result = self.merge(passthrough)
+			card = result.objList['Dv'][0]
+			self.assertEqual( card.name, 'Card' + ( passthrough == 'yours' and 'A' or 'B' ) )
+			#the device still points at the symbol its file added, wherever the merge put it
+			self.assertEqual( result.references['Sm'][ card.getKey('SmH') ].name, name )
+
+	def testBasePassthroughCopied(self):
+		self.merge('base')
+		self.assertTrue( self.devices['base'] in readFile( self.directory, 'out.smw' ) )
+
+
+if __name__ == '__main__':
+	unittest.main()
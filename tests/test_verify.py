@@ -0,0 +1,38 @@
+import unittest
+
+from helpers import smwmerge, symbol, signal, smwText, mergeTexts
+
+
+class Verifier(unittest.TestCase):
+	'''The cross reference checks of --verify'''
+	def setUp(self):
+		self.objects = [ signal(4, 'sig_4'), symbol(1, 'folder', 'mC=1', 'C1=2'), symbol(2, 'sym2', 'PrH=1', 'I1=4', 'O1=2') ]
+
+	def problems(self, objects):
+		return list( smwmerge.verifier( smwText(objects) ) )
+
+	def testClean(self):
+		self.assertEqual( self.problems(self.objects), [] )
+
+	def testDuplicateH(self):
+		self.assertEqual( self.problems( self.objects + [ symbol(2, 'again') ] ), ['Sm 2: duplicate H'] )
+
+	def testDanglingReferences(self):
+		objects = self.objects[:2] + [ symbol(2, 'sym2', 'PrH=7', 'I1=5') ]
+		self.assertEqual( sorted( self.problems(objects) ), ['Sm 2: dangling I1 -> Sg 5', 'Sm 2: dangling PrH -> Sm 7'] )
+
+	def testChildCount(self):
+		objects = [ self.objects[0], symbol(1, 'folder', 'mC=2', 'C1=2') ] + self.objects[2:]
+		self.assertEqual( self.problems(objects), ['Sm 1: mC=2 but 1 child keys'] )
+
+	def testMergedOutput(self):
+		x = smwText(self.objects)
+		a = smwText( self.objects[:1] + [ symbol(3, 'added') ] + self.objects[1:] )
+		b = smwText( self.objects[:2] + [ symbol(2, 'sym2B', 'PrH=1', 'I1=4', 'O1=2') ] )
+		result = mergeTexts( [a, b, x] )
+		self.assertTrue( 'added' in result and 'sym2B' in result )
+		self.assertEqual( list( smwmerge.verifier(result) ), [] )
+
+
+if __name__ == '__main__':
+	unittest.main()